@@ -16,12 +16,13 @@ import base64, json
 import asyncio
 from pathlib import Path
 from enum import Enum
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 from contextlib import asynccontextmanager
 
 from utils import get_min_len_path, DualMotorPathOptimizer, spDict_to_pathList, VideoCaptureProcess
 from motorManager import MotorManager, MotorManager_v2
 from machineManager import MachineManager, MachineState
+from camBroadcaster import CameraBroadcaster
 
 # TODO: 軟體按下 EmgStop 處理程序呼叫需要有API
 # TODO: 提供專門的API取得最近一次的拍照結果嗎?
@@ -60,7 +61,22 @@ class ResourceManager:
         self.distortion_coefficients = Distortion_coefficients
         
         # # TODO:更新mechine manager
-        self.machineManager = MachineManager(camera_configs, motor0_home_pos=33, motor1_home_pos=327)
+        self.machineManager = MachineManager(camera_configs, motor0_home_pos=33, motor1_home_pos=327,
+                                             calibration={
+                                                 "camera_matrix": self.camera_matrix,
+                                                 "distortion_coefficients": self.distortion_coefficients,
+                                                 "image_size": cam_data.get("image_size"),
+                                             },
+                                             composite={"height": 360, "quality": 85})
+        # 每個攝像頭一個串流廣播，所有 websocket 共用同一份編碼結果
+        preview_fps = {cfg["name"]: cfg.get("preview_fps") for cfg in camera_configs}
+        self.cam_broadcasters: Dict[str, CameraBroadcaster] = {
+            name: CameraBroadcaster(name, cap, max_fps=preview_fps.get(name))
+            for name, cap in self.machineManager.camera_list.items()
+        }
+        # 最近一次由 shot 按鈕或工件偵測觸發的掃描結果
+        self.last_scan: Optional[dict] = None
+        self.machineManager.scan_callback = lambda source: run_saved_scan(self, source)
         # self.machineGood = True
         # self.machineManager = MachineManager(self.motorV2_list, self.cameras_list)
 
@@ -80,6 +96,8 @@ class ResourceManager:
         #     pass
 
     async def cleanup(self):
+        for broadcaster in self.cam_broadcasters.values():
+            await broadcaster.stop()
         await self.machineManager.stop()
         # self.motor.closeManager()
         # await self.machineManager.closeManager()
@@ -102,17 +120,18 @@ async def lifespan(app: FastAPI):
     try:
 
         if sys.platform.startswith("win"):
+            # 沒有實體攝影機時使用測試圖樣，格式見 frameSources
             camera_configs = [
-                {"dev": "./testRes/SampleVideo_720x480_5mb.mp4", "name": "cam0"},
-                {"dev": "./testRes/SampleVideo_720x480_5mb.mp4", "name": "cam1"}
+                {"dev": "pattern:1280x1024@30", "name": "cam0", "sensor_modes": {"preview": (640, 512, 60)}},
+                {"dev": "pattern:1280x1024@30", "name": "cam1", "sensor_modes": {"preview": (640, 512, 60)}}
             ]
         else:
             
             camera_configs = [
                 # {"dev": "/dev/video0", "name": "cam0"},
                 # {"dev": "/dev/video2", "name": "cam1"}
-                {"dev": "/dev/v4l/by-path/platform-3610000.usb-usb-0:2.1.1:1.0-video-index0", "name": "cam0"},
-                {"dev": "/dev/v4l/by-path/platform-3610000.usb-usb-0:2.1.3:1.0-video-index0", "name": "cam1"}
+                {"dev": "/dev/v4l/by-path/platform-3610000.usb-usb-0:2.1.1:1.0-video-index0", "name": "cam0", "capture_mode": "mjpg", "preview_fps": 10, "presence": True},
+                {"dev": "/dev/v4l/by-path/platform-3610000.usb-usb-0:2.1.3:1.0-video-index0", "name": "cam1", "capture_mode": "mjpg", "preview_fps": 10}
             ]
 
         resources = ResourceManager('/dev/ttyUSB3', camera_configs)
@@ -181,10 +200,12 @@ def v2_get_machine_health(resources: ResourceManager = Depends(get_resources)):
     # {'health':'ok'} 
     # 馬達問題回傳 "motor"
     # 鏡頭問題回傳 "camera"
-    if not resources.machineManager.is_emergency():
-        return {'health':'ok'}
-    else:
+    if resources.machineManager.is_emergency():
         raise HTTPException(status_code=500, detail="Motor error")
+    for name in resources.machineManager.get_camera_list():
+        if not resources.machineManager.is_camera_healthy(name):
+            raise HTTPException(status_code=500, detail="Camera error")
+    return {'health':'ok'}
 
 @app.get('/v2/machine/error_log')
 def v2_get_machine_error_log(resources: ResourceManager = Depends(get_resources)):
@@ -267,28 +288,125 @@ async def v2_ws_motor_data(websocket:WebSocket ,id:int):
         logger.info(f"WebSocket connection closed for motor {id}")
         
 @app.websocket('/v2/ws/cam/{id}')
-async def v2_ws_cam(websocket:WebSocket ,id:int):
+async def v2_ws_cam(websocket:WebSocket ,id:int, level:int = 0, quality:int = 50):
+    """
+    level: 影像金字塔層級，0 為原始解析度，1 為 1/2，2 為 1/4
+    quality: JPEG 品質，MJPG 模式的原始解析度直接轉送攝影機原始 JPEG 時不生效
+    """
     await websocket.accept()
     resources :ResourceManager = websocket.app.state.resources
 
     try:
-        cap = resources.machineManager.camera_list[f"cam{id}"]
-        while True:
-            # cap:cv2.VideoCapture = resources.machineManager.camera_list[f"cam{id}"]
-            ret, frame = cap.read()
-            if not ret:
-                # cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
-                continue
-            ret, frame = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
-            if not ret:
-                continue
-            jpegb64 = base64.b64encode(frame).decode('utf-8')
-            await websocket.send_text(jpegb64)
-            await asyncio.sleep(0.01)
+        broadcaster = resources.cam_broadcasters[f"cam{id}"]
+        # 同一幀只編碼一次，再分送給所有訂閱的 websocket
+        async with broadcaster.subscribe(level=level, quality=quality) as queue:
+            while True:
+                jpegb64 = await queue.get()
+                if jpegb64 is CameraBroadcaster.CLOSED:
+                    logger.warning(f"cam{id} 影像串流已結束，關閉連線")
+                    await websocket.close(code=1011)
+                    break
+                await websocket.send_text(jpegb64)
     except WebSocketDisconnect:
         logger.info(f"WebSocket connection closed for cam {id}")
 
 
+@app.get('/v2/cam/status')
+def v2_get_cam_status(resources: ResourceManager = Depends(get_resources)):
+    """各攝像頭的擷取狀態、keep-warm 剩餘時間、喚醒後第一幀耗時，以及幀率、丟棄幀數、重啟次數等健康資訊"""
+    return resources.machineManager.get_camera_status()
+
+@app.post('/v2/cam/{id}/keep_warm')
+def v2_cam_keep_warm(id:int, seconds:float = 30.0, resources: ResourceManager = Depends(get_resources)):
+    """讓攝像頭在 seconds 秒內持續擷取，seconds <= 0 取消"""
+    cam_name = f"cam{id}"
+    if cam_name not in resources.machineManager.camera_list:
+        return JSONResponse(status_code=404, content={"error": "Camera not found"})
+    resources.machineManager.keep_warm_cameras([cam_name], seconds)
+    return resources.machineManager.get_camera_status()[cam_name]
+
+@app.post('/v2/cam/{id}/settle/calibrate')
+async def v2_cam_settle_calibrate(id:int, resources: ResourceManager = Depends(get_resources)):
+    """在機構靜止時校正攝像頭的畫面穩定門檻"""
+    cam_name = f"cam{id}"
+    if cam_name not in resources.machineManager.camera_list:
+        return JSONResponse(status_code=404, content={"error": "Camera not found"})
+    threshold = await asyncio.to_thread(resources.machineManager.calibrate_camera_settle, cam_name)
+    return {"cam": cam_name, "settle_threshold": threshold}
+
+@app.post('/v2/cam/{id}/exposure')
+async def v2_cam_exposure(id:int, value: Optional[float] = None, resources: ResourceManager = Depends(get_resources)):
+    """設定攝像頭曝光值，不帶 value 時改回自動曝光"""
+    cam_name = f"cam{id}"
+    if cam_name not in resources.machineManager.camera_list:
+        return JSONResponse(status_code=404, content={"error": "Camera not found"})
+    ok = await resources.machineManager.set_camera_exposure(cam_name, value)
+    return {"cam": cam_name, "ok": ok, "exposure": value}
+
+@app.post('/v2/cam/{id}/resolution')
+async def v2_cam_resolution(id:int, width:int, height:int, resources: ResourceManager = Depends(get_resources)):
+    """切換攝像頭擷取解析度，不能超過啟動時的解析度"""
+    cam_name = f"cam{id}"
+    if cam_name not in resources.machineManager.camera_list:
+        return JSONResponse(status_code=404, content={"error": "Camera not found"})
+    ok = await resources.machineManager.set_camera_resolution(cam_name, width, height)
+    return {"cam": cam_name, "ok": ok, "width": width, "height": height}
+
+@app.post('/v2/cam/{id}/roi/background')
+async def v2_cam_roi_background(id:int, resources: ResourceManager = Depends(get_resources)):
+    """在機台淨空時建立攝像頭的背景模型，供掃描圖片裁切到工件範圍與工件放置偵測"""
+    cam_name = f"cam{id}"
+    if cam_name not in resources.machineManager.camera_list:
+        return JSONResponse(status_code=404, content={"error": "Camera not found"})
+    # 取樣時會切換感光元件模式，掃描中不可執行
+    if resources.machineManager.is_scanning():
+        raise HTTPException(status_code=409, detail="Scan in progress")
+    if not await resources.machineManager.learn_camera_background(cam_name):
+        raise HTTPException(status_code=400, detail=f"Camera {cam_name} ROI background failed")
+    return {"cam": cam_name, "roi": True}
+
+@app.get('/v2/machine/presence')
+def v2_get_machine_presence(resources: ResourceManager = Depends(get_resources)):
+    """工件放置偵測狀態"""
+    return JSONResponse(content=resources.machineManager.get_presence_status())
+
+
+@app.post('/v2/machine/auto_scan')
+def v2_machine_auto_scan(enabled: bool, resources: ResourceManager = Depends(get_resources)):
+    """開關偵測到工件放置時自動掃描"""
+    resources.machineManager.auto_scan = enabled
+    return {"auto_scan": enabled}
+
+
+@app.get('/v2/cam/shot/last')
+def v2_get_cam_shot_last(resources: ResourceManager = Depends(get_resources)):
+    """最近一次由 shot 按鈕或工件偵測觸發的掃描結果"""
+    if resources.last_scan is None:
+        raise HTTPException(status_code=404, detail="No triggered scan yet")
+    return JSONResponse(content=resources.last_scan)
+
+
+@app.post('/v2/cam/sync_shot')
+async def v2_cam_sync_shot(max_skew: Optional[float] = None, resources: ResourceManager = Depends(get_resources)):
+    """
+    所有攝像頭同時拍照，回傳各攝像頭圖片與實際的時間差 (秒)
+    與掃描共用 scan_lock，掃描中回傳 409；拍照時切換到擷取模式，圖片存放在 syncImage，不與掃描結果一起上傳
+    """
+    machine = resources.machineManager
+    if machine.is_scanning():
+        raise HTTPException(status_code=409, detail="Scan in progress")
+    cam_names = machine.get_camera_list()
+    async with machine.scan_lock:
+        try:
+            await machine.set_camera_sensor_modes(cam_names, "capture")
+            result = await machine.capture_synchronized(cam_names, max_skew=max_skew)
+        finally:
+            await machine.set_camera_sensor_modes(cam_names, "preview")
+    if result is None:
+        raise HTTPException(status_code=503, detail="Synchronized capture failed")
+    return JSONResponse(content=result)
+
+
 def get_machien_state(resources: ResourceManager):
     # IDEL: 如果所有軸都處於正常狀態
     # SHOTTING : 拍照中返回
@@ -467,7 +585,11 @@ async def sp_move_helper(resources: ResourceManager, path1: List[float], path2:
     # 如果有拍照，整理照片結果
     image_results = {
         "cam0": results1,
-        "cam1": results2
+        "cam1": results2,
+        # 每張圖的清晰度等資訊，順序與圖片列表相同
+        "meta": resources.machineManager.scan_meta,
+        # 依角度拼接的 360° 合成圖 (未啟用時為空)
+        "composite": await resources.machineManager.build_scan_composites(),
     }
     resources.machineManager._state = MachineState.IDLE
     # await resources.machineManager.set_lamp(r=False, g=True, y=False)
@@ -550,32 +672,82 @@ async def v2_motors_spSim(spReq: MotorSetPointReq,
     return spRes
     # return simData
 
+async def run_scan(resources: ResourceManager, spDict: dict) -> Tuple[list, dict, dict]:
+    """
+    依設定點執行移動與拍照序列，回傳 (pathList, spDict, image_results)
+    手動與觸發的掃描共用 scan_lock，已有掃描在執行時回傳 409
+    """
+    scan_lock = resources.machineManager.scan_lock
+    if scan_lock.locked():
+        raise HTTPException(status_code=409, detail="Scan in progress")
+    async with scan_lock:
+        return await _scan_sequence(resources, spDict)
+
+
+async def _scan_sequence(resources: ResourceManager, spDict: dict) -> Tuple[list, dict, dict]:
+    # 清理舊檔案
+    save_dir = "motorImage"
+    if os.path.exists(save_dir):
+        for file in os.listdir(save_dir):
+            os.remove(os.path.join(save_dir, file))
+    os.makedirs(save_dir, exist_ok=True)
+
+    pathList, spDict = spDict_to_pathList(spDict)
+    optimizer = DualMotorPathOptimizer(
+        motor1_home=resources.machineManager.motor0_home_pos,
+        motor2_home=resources.machineManager.motor1_home_pos)
+    (path1, path2), total_time = optimizer.optimize_paths(pathList)
+    spDict['pos_list_multiMotor'] = {
+        "motor0":path1,
+        "motor1":path2
+    }
+
+    # 路徑確定後立即預熱會用到的攝像頭，移動期間完成喚醒與曝光穩定
+    scan_cams = [name for name, path in (("cam0", path1), ("cam1", path2)) if path]
+    # 初始化失敗或擷取進程已停止的攝像頭直接回報，不要等整趟掃描結束才發現
+    for name in scan_cams:
+        cap = resources.machineManager.camera_list.get(name)
+        if cap is None or not cap.is_alive():
+            raise HTTPException(status_code=503, detail=f"Camera {name} not available")
+    # 掃描結束後還原使用者原本設定的 keep-warm
+    warm_tokens = resources.machineManager.extend_camera_warm(scan_cams, seconds=60)
+
+    # 執行移動和拍照，掃描期間切換到全解析度的擷取模式並鎖定曝光
+    try:
+        await resources.machineManager.set_camera_sensor_modes(scan_cams, "capture")
+        await resources.machineManager.lock_camera_exposure(scan_cams)
+        image_results = await sp_move_helper(resources, path1, path2, to_shot=True)
+    except Exception as e:
+        # 掃描中途失敗時機台停在 WORKING，之後的自動掃描都會被當成忙碌而忽略；
+        # 轉為 ERROR 讓狀態與燈號可見，由解除錯誤 (resolve) 回原點後恢復 IDLE
+        if resources.machineManager._state == MachineState.WORKING:
+            await resources.machineManager._handle_error(f"掃描失敗: {e}")
+        raise
+    finally:
+        resources.machineManager.unlock_camera_exposure(scan_cams)
+        await resources.machineManager.set_camera_sensor_modes(scan_cams, "preview")
+        resources.machineManager.release_camera_warm(warm_tokens)
+    return pathList, spDict, image_results
+
+
+async def run_saved_scan(resources: ResourceManager, source: str):
+    """以保存的 SPconfig.json 執行掃描 (shot 按鈕或偵測到工件放置時觸發)，結果保存在 resources.last_scan"""
+    spDict = resources.machineManager.getSPConfig()
+    _, _, image_results = await run_scan(resources, spDict)
+    resources.last_scan = {"source": source, "ts": time.time(), "result": image_results}
+    await resources.machineManager.set_lamp(r=False, g=True, y=False)
+
+
 # 新增一個拍照的端點
 @app.post('/v2/cam/shot', description="目前暫時回傳固定測試資料")
 async def v2_cam_shot(spReq: MotorSetPointReq,
                         resources: ResourceManager = Depends(get_resources)):
     """執行拍照序列"""
+    if resources.machineManager.is_scanning():
+        raise HTTPException(status_code=409, detail="Scan in progress")
     try:
-        # 清理舊檔案
-        save_dir = "motorImage"
-        if os.path.exists(save_dir):
-            for file in os.listdir(save_dir):
-                os.remove(os.path.join(save_dir, file))
-        os.makedirs(save_dir, exist_ok=True)
-        
-        pathList, spDict = spDict_to_pathList(spReq.model_dump())
-        optimizer = DualMotorPathOptimizer(
-            motor1_home=resources.machineManager.motor0_home_pos,
-            motor2_home=resources.machineManager.motor1_home_pos)
-        (path1, path2), total_time = optimizer.optimize_paths(pathList)
-        spDict['pos_list_multiMotor'] = {
-            "motor0":path1,
-            "motor1":path2
-        }
+        pathList, spDict, image_results = await run_scan(resources, spReq.model_dump())
 
-        # 執行移動和拍照
-        image_results = await sp_move_helper(resources, path1, path2, to_shot=True)
-        
         # 保存設定點位置
         if pathList:
             with open('SPconfig.json', 'w') as f:
@@ -585,6 +757,8 @@ async def v2_cam_shot(spReq: MotorSetPointReq,
         await resources.machineManager.set_lamp(r=False, g=True, y=False)
         return JSONResponse(content=image_results)
         
+    except HTTPException:
+        raise
     except Exception as e:
         # await resources.machineManager.set_lamp(r=True, g=False, y=False)
         logger.error(f"Error in v2_cam_shot: {str(e)}")
@@ -615,7 +789,8 @@ def v2_get_motor_spInit():
 
 
 def getPostFiles_v2():
-    img_paths = os.listdir('motorImage')
+    # 只上傳各點位的圖片，不包含同名的 JSON 圖片資訊與合成圖
+    img_paths = [p for p in os.listdir('motorImage') if p.endswith('.jpg') and not p.startswith('composite_')]
     files=[]
     for i, img_path in enumerate(img_paths):
         temp = (
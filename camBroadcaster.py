@@ -0,0 +1,111 @@
+import asyncio
+import base64
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Set, Tuple
+
+from loguru import logger
+
+from utils import VideoCaptureProcess
+
+
+class CameraBroadcaster:
+    """
+    單一攝像頭的影像串流廣播
+    每個新幀在每種 (level, quality) 組合下只編碼一次，再把同一份 base64 字串發給所有訂閱者，
+    CPU 成本隨攝像頭數量增加，而不是隨觀看人數增加。
+    max_fps: 預覽幀率上限，只以此頻率向擷取進程要求新幀，其餘的幀在擷取進程中不解碼；None 為不限制
+    編碼在工作執行緒執行，不阻塞事件迴圈；廣播任務出錯或停止時對所有訂閱者送出 CLOSED
+    """
+    # 串流結束的通知，訂閱者收到後應關閉連線
+    CLOSED = None
+
+    def __init__(self, name: str, cap: VideoCaptureProcess, poll_interval: float = 0.01, max_fps: float = None):
+        self.name = name
+        self.cap = cap
+        self.poll_interval = poll_interval
+        self.frame_interval = 1.0 / max_fps if max_fps else 0.0
+        # (level, quality) -> 訂閱者佇列
+        self._subscribers: Dict[Tuple[int, int], Set[asyncio.Queue]] = {}
+        self._task: asyncio.Task = None
+
+    @asynccontextmanager
+    async def subscribe(self, level: int = 0, quality: int = 50):
+        """
+        訂閱影像串流，取得只保留最新一幀的佇列，取出 CLOSED 代表串流已結束
+        離開 context 時自動取消訂閱，沒有訂閱者時停止廣播任務
+        """
+        key = (level, quality)
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers.setdefault(key, set()).add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        try:
+            yield queue
+        finally:
+            subs = self._subscribers.get(key)
+            if subs is not None:
+                subs.discard(queue)
+                if not subs:
+                    del self._subscribers[key]
+
+    def subscriber_count(self) -> int:
+        return sum(len(subs) for subs in self._subscribers.values())
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, data: Optional[str]):
+        """慢的訂閱者只保留最新一幀"""
+        if queue.full():
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+        queue.put_nowait(data)
+
+    async def _run(self):
+        last_seq = -1
+        next_request = 0.0
+        try:
+            while self._subscribers:
+                seq = self.cap.frame_ring.latest_seq()
+                # 沒有新幀時不重複編碼，依幀率上限要求擷取進程解碼下一幀
+                if seq < 0 or seq == last_seq:
+                    now = time.monotonic()
+                    if now >= next_request:
+                        self.cap.touch()
+                        next_request = now + self.frame_interval
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                last_seq = seq
+                for key, subs in list(self._subscribers.items()):
+                    level, quality = key
+                    data = await asyncio.to_thread(self._encode, seq, level, quality)
+                    if data is None:
+                        continue
+                    for queue in list(subs):
+                        self._offer(queue, data)
+                await asyncio.sleep(self.poll_interval)
+        except Exception as e:
+            logger.error(f"攝像頭 {self.name} 廣播任務出錯: {e}")
+        finally:
+            self._task = None
+            # 出錯或被取消時通知仍在等待的訂閱者，避免連線永遠卡在等待新幀
+            for subs in self._subscribers.values():
+                for queue in subs:
+                    self._offer(queue, self.CLOSED)
+
+    def _encode(self, seq: int, level: int, quality: int) -> Optional[str]:
+        """編碼指定幀並轉為 base64 (在工作執行緒執行)，幀已被覆寫時回傳 None"""
+        ret, jpeg, _ = self.cap.read_jpeg(quality=quality, seq=seq, level=level)
+        if not ret:
+            return None
+        return base64.b64encode(jpeg).decode('utf-8')
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._subscribers.clear()
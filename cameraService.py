@@ -0,0 +1,246 @@
+import itertools
+import multiprocessing as mp
+import queue
+import threading
+import time
+
+from frameStore import H_RUNNING
+from utils import VideoCaptureProcess, video_capture_process
+
+
+# ===========================================
+# 單一攝像頭服務進程
+# ===========================================
+def camera_service_process(specs: dict, conn, stop_event):
+    """
+    在同一個進程中以執行緒擷取所有攝像頭，幀寫入各自的共享記憶體環狀緩衝
+    specs: 攝像頭名稱 -> 擷取參數 (src, frame_ring, block_event, width, height, capture_mode, lazy_decode,
+        exposure, auto_exposure, fps)
+    conn: 與主進程之間唯一的控制管道，命令為 (req_id, name, cmd, args)，回覆 (req_id, result)
+        start / restart (width, height, fps): 以指定解析度與幀率啟動、重新啟動單一攝像頭的擷取執行緒
+        stop: 停止單一攝像頭的擷取執行緒
+        其餘命令 (exposure, resolution, mode, get) 轉交該攝像頭的擷取迴圈執行，見 apply_capture_control
+    """
+    cams = {}
+    # 每次啟動遞增的世代，重新啟動時逾時未結束的舊執行緒結束時不清除新執行緒的 H_RUNNING
+    generations = dict.fromkeys(specs, 0)
+
+    def start_cam(name):
+        spec = specs[name]
+        ring = spec["frame_ring"]
+        stop = threading.Event()
+        control, reply = queue.Queue(), queue.Queue()
+        generations[name] += 1
+        generation = generations[name]
+
+        def run():
+            try:
+                video_capture_process(spec["src"], ring, stop, spec["block_event"], spec["width"], spec["height"],
+                                      spec["capture_mode"], spec["lazy_decode"], control, reply,
+                                      spec["exposure"], spec["auto_exposure"], spec["fps"])
+            finally:
+                if generations[name] == generation:
+                    ring.header[H_RUNNING] = 0
+
+        ring.header[H_RUNNING] = 1
+        thread = threading.Thread(target=run, name=f"capture-{name}", daemon=True)
+        cams[name] = {"thread": thread, "stop": stop, "control": control, "reply": reply}
+        thread.start()
+
+    def stop_cams(names, timeout=2.0):
+        # 先通知全部再一起等待，結束時間不隨攝像頭數量增加
+        for name in names:
+            cam = cams.get(name)
+            if cam is not None:
+                cam["stop"].set()
+                specs[name]["block_event"].set()
+        deadline = time.monotonic() + timeout
+        for name in names:
+            cam = cams.pop(name, None)
+            if cam is not None:
+                cam["thread"].join(timeout=max(0.0, deadline - time.monotonic()))
+
+    def forward(name, req_id, cmd, args, timeout=2.0):
+        cam = cams.get(name)
+        if cam is None or not cam["thread"].is_alive():
+            return None
+        cam["control"].put((req_id, cmd, args))
+        specs[name]["block_event"].set()
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                reply_id, result = cam["reply"].get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if reply_id == req_id:
+                return result
+
+    for name in specs:
+        start_cam(name)
+
+    while not stop_event.is_set():
+        if not conn.poll(0.2):
+            continue
+        try:
+            req_id, name, cmd, args = conn.recv()
+        except (EOFError, OSError):
+            break
+        if name not in specs:
+            result = None
+        elif cmd in ("start", "restart"):
+            if args:
+                specs[name]["width"], specs[name]["height"], specs[name]["fps"] = args
+            stop_cams([name])
+            start_cam(name)
+            result = True
+        elif cmd == "stop":
+            stop_cams([name])
+            result = True
+        else:
+            result = forward(name, req_id, cmd, args)
+        try:
+            conn.send((req_id, result))
+        except (BrokenPipeError, OSError):
+            break
+
+    stop_cams(list(cams))
+    print("攝像頭服務進程已結束")
+
+
+class CameraService:
+    """
+    所有攝像頭共用的擷取進程
+    攝像頭 (ServiceCamera) 需在 start() 之前全部建立，事件物件只能在建立進程時傳入
+    讀取端仍直接讀取各攝像頭的共享記憶體，只有控制命令經過管道
+    """
+    def __init__(self):
+        self.cameras = {}
+        self.process = None
+        self.stop_event = mp.Event()
+        self._conn = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+
+    def add(self, name: str, cam: "ServiceCamera"):
+        if self.process is not None:
+            raise RuntimeError("攝像頭服務已啟動，無法再加入攝像頭")
+        self.cameras[name] = cam
+
+    def start(self):
+        specs = {name: cam.spec() for name, cam in self.cameras.items()}
+        self.stop_event.clear()
+        self._conn, child_conn = mp.Pipe()
+        self.process = mp.Process(target=camera_service_process, args=(specs, child_conn, self.stop_event),
+                                  daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def request(self, name: str, cmd: str, *args, timeout: float = 3.0):
+        """送出控制命令並等待回覆，服務未執行或逾時回傳 None (阻塞)"""
+        with self._lock:
+            if not self.is_alive():
+                return None
+            req_id = next(self._ids)
+            try:
+                self._conn.send((req_id, name, cmd, args))
+                deadline = time.monotonic() + timeout
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._conn.poll(remaining):
+                        return None
+                    reply_id, result = self._conn.recv()
+                    # 丟棄先前逾時的命令遲到的回覆
+                    if reply_id == req_id:
+                        return result
+            except (EOFError, BrokenPipeError, OSError):
+                return None
+
+    def restart(self):
+        """服務進程結束時整個重新啟動"""
+        with self._lock:
+            if self.is_alive():
+                return
+            self._stop_process()
+            self.start()
+
+    def _stop_process(self):
+        self.stop_event.set()
+        for cam in self.cameras.values():
+            cam.block_event.set()
+        if self.process is not None:
+            self.process.join(timeout=3)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join(timeout=2)
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def stop(self):
+        """停止服務進程並釋放所有攝像頭的共享記憶體"""
+        self._stop_process()
+        for cam in self.cameras.values():
+            cam.frame_ring.close()
+
+
+class ServiceCamera(VideoCaptureProcess):
+    """
+    由 CameraService 擷取的攝像頭，讀取介面與 VideoCaptureProcess 相同
+    keep-warm 與閒置時間仍直接寫在共享記憶體 header，不經過管道
+    """
+    def __init__(self, service: CameraService, name: str, src, **kwargs):
+        super().__init__(src, **kwargs)
+        self.service = service
+        self.name = name
+        service.add(name, self)
+
+    @staticmethod
+    def _new_queue():
+        # 控制命令經由 CameraService 的管道傳送，不需要跨進程佇列
+        return queue.Queue()
+
+    def spec(self) -> dict:
+        return {
+            "src": self.src,
+            "frame_ring": self.frame_ring,
+            "block_event": self.block_event,
+            "width": self.width,
+            "height": self.height,
+            "capture_mode": self.capture_mode,
+            "lazy_decode": self.lazy_decode,
+            "exposure": self.exposure,
+            "auto_exposure": self.auto_exposure,
+            "fps": self.fps,
+        }
+
+    def start(self):
+        """服務已在執行時啟動此攝像頭的擷取執行緒，否則等服務啟動時一起開始"""
+        if self.service.is_alive():
+            self.service.request(self.name, "start", self.width, self.height, self.fps)
+
+    def is_alive(self) -> bool:
+        return self.service.is_alive() and bool(self.frame_ring.header[H_RUNNING])
+
+    def restart(self):
+        if not self.service.is_alive():
+            self.service.restart()
+        else:
+            self.service.request(self.name, "restart", self.width, self.height, self.fps)
+        self.restart_count += 1
+        self.last_restart = time.monotonic()
+
+    def _control_request(self, cmd: str, *args, timeout: float = 2.0):
+        return self.service.request(self.name, cmd, *args, timeout=timeout + 1.0)
+
+    def _stop_process(self):
+        self.service.request(self.name, "stop")
+
+    def stop(self):
+        """停止此攝像頭的擷取，共享記憶體在 CameraService.stop() 時統一釋放"""
+        self._stop_process()
@@ -0,0 +1,400 @@
+import cv2
+import numpy as np
+
+
+# ===========================================
+# 影像分析工具 (在擷取進程或工作執行緒中使用)
+# ===========================================
+def downscale_gray(frame: np.ndarray, width: int = 160) -> np.ndarray:
+    """縮小並轉為灰階，供運動量等低成本分析使用"""
+    h, w = frame.shape[:2]
+    if w > width:
+        size = (width, max(1, round(h * width / w)))
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    if frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return frame
+
+
+# JPEG 可在解碼時以 DCT 直接縮小的倍率
+_REDUCED_COLOR_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def build_pyramid(frame: np.ndarray, divisors, buffers=None) -> list:
+    """
+    依縮小倍率產生縮圖列表 (不含原圖)，由大到小逐層縮小以降低運算量
+    divisors: 例如 (2, 4)，需遞增
+    buffers: 預先配置的輸出緩衝，尺寸相符時直接縮小到緩衝中，不另外配置
+    """
+    h, w = frame.shape[:2]
+    out = []
+    src = frame
+    for i, d in enumerate(divisors):
+        size = (max(1, w // d), max(1, h // d))
+        dst = buffers[i] if buffers and i < len(buffers) else None
+        if dst is not None and dst.shape == (size[1], size[0]) + src.shape[2:]:
+            src = cv2.resize(src, size, dst=dst, interpolation=cv2.INTER_AREA)
+        else:
+            src = cv2.resize(src, size, interpolation=cv2.INTER_AREA)
+        out.append(src)
+    return out
+
+
+def decode_pyramid(jpeg: np.ndarray, divisors) -> list:
+    """
+    直接由 JPEG 解碼各層縮圖
+    支援 DCT 縮放的倍率 (2, 4, 8) 在解碼時直接縮小，不需要先完整解碼
+    其餘倍率才完整解碼一次後縮小
+    """
+    out = []
+    full = None
+    for d in divisors:
+        flag = _REDUCED_COLOR_FLAGS.get(d)
+        if flag is not None:
+            out.append(cv2.imdecode(jpeg, flag))
+            continue
+        if full is None:
+            full = cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+        out.append(build_pyramid(full, (d,))[0])
+    return out
+
+
+def motion_energy(prev_small: np.ndarray, small: np.ndarray) -> float:
+    """
+    相鄰兩幀縮圖的平均絕對差 (0~255 灰階)
+    尺寸不同 (例如解析度切換) 時視為劇烈變化
+    """
+    if prev_small is None or prev_small.shape != small.shape:
+        return 255.0
+    return float(cv2.absdiff(prev_small, small).mean())
+
+
+def luminance_stats(gray: np.ndarray, clip_low: int = 5, clip_high: int = 250):
+    """
+    以 256 階直方圖計算亮度統計
+    回傳 (平均亮度, 過曝比例, 過暗比例)
+    """
+    hist = np.bincount(gray.ravel(), minlength=256)
+    total = max(int(hist.sum()), 1)
+    mean = float(np.dot(hist, np.arange(256))) / total
+    return mean, float(hist[clip_high:].sum()) / total, float(hist[:clip_low + 1].sum()) / total
+
+
+class ExposureController:
+    """
+    軟體自動曝光，假設平均亮度與曝光值大致成正比
+    每次調整後等待 settle_frames 幀讓設定生效，每步倍率限制在 max_step 內，
+    達到目標 (平均亮度誤差在 tolerance 內且過曝比例低於 max_clip) 或超過 max_steps 步即停止調整
+    """
+    ADJUSTING, CONVERGED, GAVE_UP = 1, 2, 4
+
+    def __init__(self, exposure: float = 150, target_mean: float = 110, tolerance: float = 10,
+                 max_clip: float = 0.01, min_exposure: float = 1, max_exposure: float = 5000,
+                 max_step: float = 2.0, settle_frames: int = 2, max_steps: int = 8):
+        self.exposure = float(exposure)
+        self.target_mean = target_mean
+        self.tolerance = tolerance
+        self.max_clip = max_clip
+        self.min_exposure = min_exposure
+        self.max_exposure = max_exposure
+        self.max_step = max_step
+        self.settle_frames = settle_frames
+        self.max_steps = max_steps
+        self.mean = float('nan')
+        self.reset()
+
+    def reset(self):
+        """重新開始收斂 (例如閒置喚醒後光線可能已改變)"""
+        self.state = self.ADJUSTING
+        self.steps = 0
+        self._wait = self.settle_frames
+
+    def update(self, gray: np.ndarray):
+        """
+        輸入一幀縮小後的灰階影像，需要調整時回傳新的曝光值，否則回傳 None
+        """
+        if self.state != self.ADJUSTING:
+            return None
+        if self._wait > 0:
+            # 等待上一步設定生效
+            self._wait -= 1
+            return None
+        mean, clip_hi, _ = luminance_stats(gray)
+        self.mean = mean
+        if abs(mean - self.target_mean) <= self.tolerance and clip_hi <= self.max_clip:
+            self.state = self.CONVERGED
+            return None
+        if self.steps >= self.max_steps:
+            self.state = self.GAVE_UP
+            return None
+        ratio = self.target_mean / max(mean, 1.0)
+        if clip_hi > self.max_clip:
+            # 過曝時平均值低估了實際亮度，至少降低一定比例
+            ratio = min(ratio, 0.8)
+        ratio = min(max(ratio, 1.0 / self.max_step), self.max_step)
+        exposure = min(max(self.exposure * ratio, self.min_exposure), self.max_exposure)
+        self.steps += 1
+        self._wait = self.settle_frames
+        if abs(exposure - self.exposure) < 1e-6:
+            # 已到曝光上下限，無法再調整
+            self.state = self.GAVE_UP
+            return None
+        self.exposure = exposure
+        return exposure
+
+
+def sharpness(frame: np.ndarray, width: int = 320) -> float:
+    """
+    對焦 / 動態模糊指標: 縮小後灰階影像的 Laplacian 變異數
+    越大越清晰，數值與畫面內容有關，門檻需依各攝像頭實際場景設定
+    """
+    small = downscale_gray(frame, width)
+    _, std = cv2.meanStdDev(cv2.Laplacian(small, cv2.CV_16S, ksize=3))
+    return float(std[0, 0] ** 2)
+
+
+def calibrate_threshold(energies, k: float = 4.0, floor: float = 0.5) -> float:
+    """
+    以靜止畫面的運動量樣本估計穩定門檻
+    門檻 = 平均 + k * 標準差，並保留最小值避免雜訊極低時過於嚴格
+    """
+    e = np.asarray(energies, dtype=np.float64)
+    if e.size == 0:
+        return floor
+    return max(floor, float(e.mean() + k * e.std()))
+
+
+def merge_burst(frames, method: str = "mean") -> np.ndarray:
+    """
+    合併連拍的多張幀以降低雜訊
+    method: "mean" 平均 (雜訊下降約 1/sqrt(K))，"median" 中位數 (可去除偶發的離群像素)
+    尺寸不一致的幀 (例如中途切換解析度) 會被略過
+    """
+    frames = [f for f in frames if f is not None and f.shape == frames[0].shape]
+    if len(frames) == 1:
+        return frames[0]
+    stack = np.stack(frames, axis=0)
+    if method == "median":
+        merged = np.median(stack, axis=0)
+    elif method == "mean":
+        merged = stack.mean(axis=0, dtype=np.float32)
+    else:
+        raise ValueError(f"未知的合併方式: {method}")
+    return np.clip(np.rint(merged), 0, 255).astype(np.uint8)
+
+
+class UndistortMapCache:
+    """
+    鏡頭畸變校正的查表快取
+    cv2.initUndistortRectifyMap 只在每個解析度第一次使用時計算，之後每幀只需一次 cv2.remap
+    camera_matrix / dist_coeffs: 來自 camData.json
+    calib_size: 標定時的影像尺寸 (w, h)，與實際解析度不同時等比例縮放內參；
+    長寬比不同的解析度 (感光元件裁切範圍不同) 無法以縮放換算，不支援
+    """
+    # 長寬比允許的相對誤差
+    ASPECT_TOLERANCE = 0.01
+
+    def __init__(self, camera_matrix, dist_coeffs, calib_size):
+        self.camera_matrix = np.asarray(camera_matrix, dtype=np.float64)
+        self.dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64)
+        self.calib_size = tuple(calib_size) if calib_size else None
+        self._maps = {}
+
+    def supports(self, size) -> bool:
+        """(w, h) 解析度與標定尺寸的長寬比相同，可以縮放內參校正"""
+        if not self.calib_size:
+            return False
+        calib_aspect = self.calib_size[0] / self.calib_size[1]
+        return abs(size[0] / size[1] / calib_aspect - 1) <= self.ASPECT_TOLERANCE
+
+    def _scaled_matrix(self, size):
+        K = self.camera_matrix.copy()
+        if tuple(size) != self.calib_size:
+            sx = size[0] / self.calib_size[0]
+            sy = size[1] / self.calib_size[1]
+            K[0, 0] *= sx
+            K[0, 2] *= sx
+            K[1, 1] *= sy
+            K[1, 2] *= sy
+        return K
+
+    def get_maps(self, size):
+        """取得 (w, h) 解析度的查表，沒有時建立並快取，不支援的解析度 (見 supports) 拋出 ValueError"""
+        size = (int(size[0]), int(size[1]))
+        maps = self._maps.get(size)
+        if maps is None:
+            if not self.supports(size):
+                raise ValueError(f"解析度 {size[0]}x{size[1]} 與標定尺寸 {self.calib_size} 的長寬比不同，無法校正")
+            K = self._scaled_matrix(size)
+            # CV_16SC2 定點格式的 remap 速度最快
+            maps = cv2.initUndistortRectifyMap(K, self.dist_coeffs, None, K, size, cv2.CV_16SC2)
+            self._maps[size] = maps
+        return maps
+
+    def remap(self, frame: np.ndarray) -> np.ndarray:
+        h, w = frame.shape[:2]
+        map1, map2 = self.get_maps((w, h))
+        return cv2.remap(frame, map1, map2, interpolation=cv2.INTER_LINEAR)
+
+
+class RoiDetector:
+    """
+    以空機台背景模型找出工件範圍
+    背景為空機台多幀縮圖的逐像素中位數，雜訊門檻取逐像素標準差，全部以向量運算完成
+    scale: 偵測時的縮小倍率，只影響邊界精度 (約 scale 像素)
+    diff_threshold: 與背景的最小差異 (0~255)，noise_k: 雜訊標準差的倍數
+    margin: 外框向外延伸的比例，min_area: 前景面積低於全畫面此比例時視為沒有工件
+    """
+    def __init__(self, scale: int = 4, diff_threshold: float = 25.0, noise_k: float = 4.0,
+                 margin: float = 0.05, min_area: float = 0.002):
+        self.scale = scale
+        self.diff_threshold = diff_threshold
+        self.noise_k = noise_k
+        self.margin = margin
+        self.min_area = min_area
+        self.background = None
+        self.threshold = None
+        self._open_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+        self._close_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9, 9))
+
+    @property
+    def ready(self) -> bool:
+        return self.background is not None
+
+    def _small(self, frame: np.ndarray) -> np.ndarray:
+        h, w = frame.shape[:2]
+        size = (max(1, w // self.scale), max(1, h // self.scale))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def learn(self, frames):
+        """以空機台的多幀建立背景模型"""
+        stack = np.stack([self._small(f) for f in frames], axis=0).astype(np.float32)
+        self.background = np.median(stack, axis=0)
+        noise = stack.std(axis=0).max(axis=-1) if stack.ndim == 4 else stack.std(axis=0)
+        self.threshold = np.maximum(self.diff_threshold, self.noise_k * noise).astype(np.float32)
+
+    def save(self, path: str):
+        np.savez_compressed(path, background=self.background, threshold=self.threshold)
+
+    def load(self, path: str):
+        data = np.load(path)
+        self.background = data["background"]
+        self.threshold = data["threshold"]
+
+    def foreground_mask(self, frame: np.ndarray) -> np.ndarray:
+        """與背景差異超過門檻的前景遮罩 (縮圖尺寸)，經開運算去雜點、閉運算補洞"""
+        diff = np.abs(self._small(frame).astype(np.float32) - self.background)
+        if diff.ndim == 3:
+            diff = diff.max(axis=-1)
+        mask = (diff > self.threshold).astype(np.uint8)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self._open_kernel)
+        return cv2.morphologyEx(mask, cv2.MORPH_CLOSE, self._close_kernel)
+
+    def find_roi(self, frame: np.ndarray):
+        """
+        回傳工件外框 (x, y, w, h) (原圖座標)
+        尚未建立背景、解析度與背景不符或沒有工件時回傳 None
+        """
+        if self.background is None or self._small(frame).shape[:2] != self.background.shape[:2]:
+            return None
+        mask = self.foreground_mask(frame)
+        points = cv2.findNonZero(mask)
+        if points is None or len(points) < self.min_area * mask.size:
+            return None
+        x, y, w, h = cv2.boundingRect(points)
+        H, W = frame.shape[:2]
+        pad_x, pad_y = int(W * self.margin), int(H * self.margin)
+        x0 = max(0, x * self.scale - pad_x)
+        y0 = max(0, y * self.scale - pad_y)
+        x1 = min(W, (x + w) * self.scale + pad_x)
+        y1 = min(H, (y + h) * self.scale + pad_y)
+        return x0, y0, x1 - x0, y1 - y0
+
+
+class PresenceDetector:
+    """
+    以空轉盤背景模型偵測工件放置，輸入預覽用的低解析度灰階縮圖 (downscale_gray)
+    前景比例超過 min_fill 且連續 stable_time 秒運動量低於 motion_threshold 時觸發一次，
+    觸發後需等畫面回到空轉盤 empty_time 秒才會再次觸發 (取走工件)
+    空轉盤且靜止時以 adapt_rate 緩慢更新背景，跟隨環境光變化
+    """
+    EMPTY, PLACING, TRIGGERED = "empty", "placing", "triggered"
+
+    def __init__(self, diff_threshold: float = 20.0, noise_k: float = 4.0, min_fill: float = 0.01,
+                 motion_threshold: float = 2.0, stable_time: float = 1.0, empty_time: float = 1.0,
+                 adapt_rate: float = 0.02):
+        self.diff_threshold = diff_threshold
+        self.noise_k = noise_k
+        self.min_fill = min_fill
+        self.motion_threshold = motion_threshold
+        self.stable_time = stable_time
+        self.empty_time = empty_time
+        self.adapt_rate = adapt_rate
+        self.background = None
+        self.threshold = None
+        self.state = self.EMPTY
+        self.fill = 0.0
+        self._prev = None
+        self._still_since = None
+        self._empty_since = None
+
+    @property
+    def ready(self) -> bool:
+        return self.background is not None
+
+    def learn(self, grays):
+        """以空轉盤的多幀灰階縮圖建立背景模型"""
+        stack = np.stack(list(grays), axis=0).astype(np.float32)
+        self.background = np.median(stack, axis=0)
+        self.threshold = np.maximum(self.diff_threshold, self.noise_k * stack.std(axis=0)).astype(np.float32)
+        self.state = self.EMPTY
+        self._prev = None
+
+    def save(self, path: str):
+        np.savez_compressed(path, background=self.background, threshold=self.threshold)
+
+    def load(self, path: str):
+        data = np.load(path)
+        self.background = data["background"].astype(np.float32)
+        self.threshold = data["threshold"]
+
+    def hold(self):
+        """視為已觸發 (例如手動掃描期間)，取走工件後才會再次觸發"""
+        self.state = self.TRIGGERED
+        self._empty_since = None
+
+    def update(self, gray: np.ndarray, ts: float) -> bool:
+        """輸入一幀灰階縮圖與時間戳 (秒)，新放置的工件靜止達 stable_time 時回傳 True"""
+        if self.background is None or gray.shape != self.background.shape:
+            return False
+        self.fill = float(np.count_nonzero(np.abs(gray - self.background) > self.threshold)) / gray.size
+        still = motion_energy(self._prev, gray) < self.motion_threshold
+        self._prev = gray
+        if self.fill < self.min_fill:
+            self._still_since = None
+            if still and self.adapt_rate > 0:
+                cv2.accumulateWeighted(gray, self.background, self.adapt_rate)
+            if self.state == self.PLACING:
+                self.state = self.EMPTY
+            elif self.state == self.TRIGGERED:
+                if self._empty_since is None:
+                    self._empty_since = ts
+                elif ts - self._empty_since >= self.empty_time:
+                    self.state = self.EMPTY
+            return False
+        self._empty_since = None
+        if self.state == self.TRIGGERED:
+            return False
+        self.state = self.PLACING
+        if not still:
+            self._still_since = None
+        elif self._still_since is None:
+            self._still_since = ts
+        elif ts - self._still_since >= self.stable_time:
+            self.state = self.TRIGGERED
+            return True
+        return False
@@ -0,0 +1,271 @@
+"""
+不需要實體攝影機的影像來源，介面與 cv2.VideoCapture 相同 (isOpened / read / set / get / release)
+供 VideoCaptureProcess 在開發機或建置機上做可重現的擷取與串流量測
+
+來源字串格式 (寫在 camera config 的 "dev"):
+    pattern:1280x1024@30        產生測試圖樣，解析度與幀率
+    loop:./testRes/a.mp4@30     循環播放影片檔，省略 @fps 時使用影片本身的幀率
+    images:./testRes/*.png@10   循環播放圖片序列 (glob 或資料夾)
+其他字串或整數仍交給 cv2.VideoCapture
+
+每一幀左上角以黑白方塊嵌入 32 位元的幀計數器，讀取端用 read_counter() 解出，
+比對前後兩幀即可統計丟棄與重複的幀
+設定 CAP_PROP_EXPOSURE 時依曝光值與 REFERENCE_EXPOSURE 的比例調整亮度，模擬曝光變化
+設定 CAP_PROP_FRAME_WIDTH / HEIGHT / FPS 時改變輸出解析度與幀率，模擬感光元件模式切換
+"""
+import glob
+import os
+import re
+import time
+
+import cv2
+import numpy as np
+
+COUNTER_BITS = 32
+# 原始影像亮度對應的曝光值
+REFERENCE_EXPOSURE = 150.0
+
+_SRC_RE = re.compile(r'^(pattern|loop|images):(.*?)(?:@(\d+(?:\.\d+)?))?$')
+
+
+def _counter_block(width: int) -> int:
+    """計數器方塊邊長，與影像寬度成比例，縮小後的金字塔層級也能讀取"""
+    return max(1, width // (COUNTER_BITS * 2))
+
+
+def embed_counter(frame: np.ndarray, counter: int):
+    """在 frame 左上角原地寫入幀計數器"""
+    block = _counter_block(frame.shape[1])
+    bits = (int(counter) >> np.arange(COUNTER_BITS)) & 1
+    strip = np.repeat(bits.astype(np.uint8) * 255, block)
+    frame[:block, :strip.size] = strip[None, :, None] if frame.ndim == 3 else strip[None, :]
+
+
+def read_counter(frame: np.ndarray) -> int:
+    """從 frame (任一金字塔層級) 讀出 embed_counter 寫入的計數器"""
+    block = _counter_block(frame.shape[1])
+    centers = np.arange(COUNTER_BITS) * block + block // 2
+    row = frame[block // 2, centers]
+    if row.ndim > 1:
+        row = row.mean(axis=1)
+    bits = (row > 127).astype(np.int64)
+    return int((bits << np.arange(COUNTER_BITS)).sum())
+
+
+def count_gaps(counters) -> dict:
+    """
+    依讀取到的計數器序列統計
+    dropped: 跳過的幀數，duplicated: 重複讀到同一幀的次數
+    """
+    counters = np.asarray(list(counters), dtype=np.int64)
+    if counters.size < 2:
+        return {"frames": int(counters.size), "dropped": 0, "duplicated": 0}
+    diff = np.diff(counters)
+    return {
+        "frames": int(counters.size),
+        "dropped": int(np.clip(diff - 1, 0, None).sum()),
+        "duplicated": int((diff == 0).sum()),
+    }
+
+
+def test_pattern(width: int, height: int) -> np.ndarray:
+    """彩條加灰階漸層的測試圖樣"""
+    bars = np.array([[255, 255, 255], [0, 255, 255], [255, 255, 0], [0, 255, 0],
+                     [255, 0, 255], [0, 0, 255], [255, 0, 0], [0, 0, 0]], dtype=np.uint8)
+    frame = np.empty((height, width, 3), np.uint8)
+    split = height * 2 // 3
+    cols = np.arange(width) * len(bars) // width
+    frame[:split] = bars[cols][None]
+    ramp = (np.arange(width) * 255 // max(width - 1, 1)).astype(np.uint8)
+    frame[split:] = ramp[None, :, None]
+    return frame
+
+
+class _PacedSource:
+    """依設定幀率節流的來源基底類別，read() 的阻塞行為與實體攝影機相同"""
+    backend_name = "SYNTH"
+
+    def __init__(self, fps: float):
+        self.fps = float(fps) if fps else 30.0
+        self.counter = 0
+        self._next_ts = None
+        self._opened = True
+        self.exposure = REFERENCE_EXPOSURE
+
+    def _wait_next(self):
+        period = 1.0 / self.fps
+        now = time.perf_counter()
+        if self._next_ts is None or now - self._next_ts > period:
+            # 第一幀或讀取端落後太多時重新對齊，不補發積欠的幀
+            self._next_ts = now
+        elif self._next_ts > now:
+            time.sleep(self._next_ts - now)
+        self._next_ts += period
+
+    def _next_frame(self):
+        raise NotImplementedError
+
+    def grab(self):
+        """等到下一幀的時間並前進一幀，不產生影像"""
+        if not self._opened:
+            return False
+        self._wait_next()
+        self._grabbed = self._next_frame()
+        self._grabbed_counter = self.counter
+        self.counter += 1
+        return self._grabbed is not None
+
+    def retrieve(self, image=None):
+        """產生最近一次 grab 的影像並嵌入計數器"""
+        frame = getattr(self, "_grabbed", None)
+        if frame is None:
+            return False, None
+        if image is not None and image.shape == frame.shape:
+            np.copyto(image, frame)
+            frame = image
+        else:
+            frame = frame.copy()
+        if self.exposure != REFERENCE_EXPOSURE:
+            cv2.convertScaleAbs(frame, dst=frame, alpha=self.exposure / REFERENCE_EXPOSURE)
+        embed_counter(frame, self._grabbed_counter)
+        return True, frame
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def isOpened(self) -> bool:
+        return self._opened
+
+    def getBackendName(self) -> str:
+        return self.backend_name
+
+    def set(self, prop, value) -> bool:
+        if prop == cv2.CAP_PROP_EXPOSURE:
+            self.exposure = max(float(value), 0.0)
+            return True
+        if prop == cv2.CAP_PROP_FRAME_WIDTH and value > 0:
+            self.width = int(value)
+            return True
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT and value > 0:
+            self.height = int(value)
+            return True
+        if prop == cv2.CAP_PROP_FPS and value > 0:
+            self.fps = float(value)
+            return True
+        return False
+
+    def get(self, prop) -> float:
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop == cv2.CAP_PROP_EXPOSURE:
+            return self.exposure
+        return 0.0
+
+    def release(self):
+        self._opened = False
+
+
+class TestPatternSource(_PacedSource):
+    """產生固定圖樣，只有計數器區塊逐幀變化"""
+    def __init__(self, width: int = 1280, height: int = 1024, fps: float = 30.0):
+        super().__init__(fps)
+        self.width, self.height = int(width), int(height)
+        self._frame = test_pattern(self.width, self.height)
+
+    def _next_frame(self):
+        if self._frame.shape[:2] != (self.height, self.width):
+            self._frame = test_pattern(self.width, self.height)
+        return self._frame
+
+
+class ImageSequenceSource(_PacedSource):
+    """循環播放圖片序列，所有圖片在開啟時載入並縮放到指定解析度"""
+    def __init__(self, pattern: str, width: int = 1280, height: int = 1024, fps: float = 10.0):
+        super().__init__(fps)
+        self.width, self.height = int(width), int(height)
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        self._frames = []
+        for path in sorted(glob.glob(pattern)):
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+            if img is None:
+                continue
+            if img.shape[:2] != (self.height, self.width):
+                img = cv2.resize(img, (self.width, self.height), interpolation=cv2.INTER_AREA)
+            self._frames.append(img)
+        self._opened = bool(self._frames)
+        self._index = 0
+        # 解析度切換後由原始尺寸的圖片縮放，結果依解析度快取
+        self._scaled = {}
+
+    def _next_frame(self):
+        frame = self._frames[self._index]
+        size = (self.width, self.height)
+        if frame.shape[:2] != (self.height, self.width):
+            key = (self._index, size)
+            if key not in self._scaled:
+                self._scaled[key] = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            frame = self._scaled[key]
+        self._index = (self._index + 1) % len(self._frames)
+        return frame
+
+
+class LoopingFileSource(_PacedSource):
+    """循環播放影片檔，播完後回到第一幀，fps 為 None 時使用影片本身的幀率"""
+    def __init__(self, path: str, width: int = 1280, height: int = 1024, fps: float = None):
+        self._cap = cv2.VideoCapture(path)
+        file_fps = self._cap.get(cv2.CAP_PROP_FPS) if self._cap.isOpened() else 0
+        super().__init__(fps or file_fps or 30.0)
+        self.width, self.height = int(width), int(height)
+        self._opened = self._cap.isOpened()
+
+    def _next_frame(self):
+        ret, frame = self._cap.read()
+        if not ret:
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self._cap.read()
+            if not ret:
+                return None
+        if frame.shape[:2] != (self.height, self.width):
+            frame = cv2.resize(frame, (self.width, self.height), interpolation=cv2.INTER_AREA)
+        return frame
+
+    def release(self):
+        super().release()
+        self._cap.release()
+
+
+def is_synthetic(src) -> bool:
+    return isinstance(src, str) and _SRC_RE.match(src) is not None
+
+
+def source_size(src, width: int, height: int):
+    """來源字串有指定解析度 (pattern:WxH) 時回傳該解析度，否則回傳 (width, height)"""
+    m = _SRC_RE.match(src) if isinstance(src, str) else None
+    if m is not None and m.group(1) == "pattern" and m.group(2):
+        width, height = (int(x) for x in m.group(2).lower().split("x"))
+    return width, height
+
+
+def open_source(src, width: int = 1280, height: int = 1024):
+    """
+    依來源字串開啟影像來源，格式見模組說明
+    無法辨識的來源交給 cv2.VideoCapture
+    """
+    m = _SRC_RE.match(src) if isinstance(src, str) else None
+    if m is None:
+        return cv2.VideoCapture(src)
+    kind, arg, fps = m.group(1), m.group(2), m.group(3)
+    fps = float(fps) if fps else None
+    if kind == "pattern":
+        width, height = source_size(src, width, height)
+        return TestPatternSource(width, height, fps or 30.0)
+    if kind == "images":
+        return ImageSequenceSource(arg, width, height, fps or 10.0)
+    return LoopingFileSource(arg, width, height, fps)
@@ -0,0 +1,379 @@
+from dataclasses import dataclass
+import time
+
+import numpy as np
+from multiprocessing import shared_memory
+
+
+# ===========================================
+# 共享記憶體環狀幀緩衝
+# ===========================================
+# header 欄位
+H_LATEST = 0        # 最新完成寫入的序號，-1 代表尚無幀
+H_DEMAND_NS = 1     # 讀取端最後一次要求幀的時間
+H_WARM_UNTIL_NS = 2 # 保持擷取 (keep-warm) 到此時間
+H_IDLE_NS = 3       # 沒有讀取需求超過此時間即停止擷取
+H_AWAKE = 4         # 擷取進程是否正在擷取
+H_WAKE_LAT_NS = 5   # 最近一次喚醒到第一幀的耗時
+H_WAKE_COUNT = 6    # 喚醒次數
+H_WAKE_NS = 7       # 最近一次喚醒的時間
+H_DROPPED = 8       # 讀取失敗或無法寫入而丟棄的幀數
+H_FPS = 9           # 實際擷取幀率 (float64，指數平均)
+H_DEMAND_SEQ = 10   # 讀取端要求新幀的計數，與上次解碼時不同才解碼
+H_GRABBED = 11      # 從攝影機取得 (grab) 的幀數
+H_DECODED = 12      # 實際解碼並寫入緩衝的幀數
+H_GRAB_NS = 13      # 最近一次 grab 成功的時間
+H_POOL_HITS = 14    # 直接解碼到 slot 緩衝的幀數
+H_POOL_MISSES = 15  # 尺寸或格式不符，另外配置後再複製的幀數
+H_RUNNING = 16      # 擷取執行緒是否在執行 (camera service 使用)
+H_AE_STATE = 17     # 自動曝光狀態: 0 關閉，1 調整中，2 已收斂，4 達步數上限或曝光上下限
+H_AE_LOCK = 18      # 讀取端設定為 1 時鎖定目前的曝光值
+H_EXPOSURE = 19     # 目前曝光值 (float64)
+H_AE_MEAN = 20      # 最近一次量測的平均亮度 (float64)
+H_AE_STEPS = 21     # 本次收斂已調整的步數
+H_MODE_LAT_NS = 22  # 最近一次切換感光元件模式 (解析度 / 幀率) 到第一幀的耗時 (ns)
+H_MODE_SWITCHES = 23  # 已完成的模式切換次數
+HEADER_WORDS = 32
+
+# 每個 slot 的 meta 欄位
+M_SEQ = 0           # 此 slot 內幀的序號，-1 代表正在寫入
+M_H = 1
+M_W = 2
+M_C = 3
+M_TS = 4            # 擷取完成時間，time.monotonic_ns()
+M_MOTION = 5        # 與前一幀的運動量 (float64)
+M_JLEN = 6          # 原始 JPEG 長度，0 代表沒有保留
+M_LVL = 7           # 金字塔第 1 層起，每層 (h, w, c) 三個欄位
+MAX_LEVELS = 4      # 含原始解析度
+META_WORDS = M_LVL + 3 * (MAX_LEVELS - 1)
+
+
+@dataclass
+class FrameInfo:
+    seq:int = -1
+    ts:float = 0.0  # 與 time.monotonic() 同一時鐘 (秒)
+    motion:float = float('nan')  # 與前一幀縮圖的平均絕對差
+    has_frame:bool = True        # 是否有解碼後的像素資料
+    jpeg_len:int = 0             # 攝影機原始 JPEG 長度，0 代表沒有保留
+
+
+def same_buffer(a: np.ndarray, b: np.ndarray) -> bool:
+    """b 已經直接寫在 a 的記憶體上 (slot_buffers 取得的緩衝)"""
+    return a.shape == b.shape and a.__array_interface__['data'][0] == b.__array_interface__['data'][0]
+
+
+def monotonic_ns() -> int:
+    """幀時間戳使用的時鐘，跨進程共用"""
+    return time.monotonic_ns()
+
+
+class SharedFrameRing:
+    """
+    固定大小的共享記憶體環狀幀緩衝
+    寫入端 (擷取進程) 依序號輪流寫入 slot，讀取端以序號檢查資料是否仍有效，
+    讀取時直接回傳指向共享記憶體的 numpy view，不需要經過 pickle。
+
+    name: 共享記憶體名稱，None 代表建立新的區塊
+    nslots: slot 數量
+    slot_shape: 單一幀的最大尺寸 (h, w, c)
+    jpeg_capacity: 每個 slot 保留原始 JPEG 的容量 (bytes)，0 代表不保留
+    levels: 影像金字塔的縮小倍率，第一層必須為 1 (原始解析度)，例如 (1, 2, 4)
+    local: 配置在本進程記憶體而非共享記憶體，供同一進程內的擷取執行緒使用，不能傳給子進程
+    """
+    def __init__(self, name=None, nslots=4, slot_shape=(1024, 1280, 3), create=True, jpeg_capacity=0,
+                 levels=(1,), local=False):
+        self.nslots = int(nslots)
+        self.slot_shape = tuple(int(x) for x in slot_shape)
+        self.slot_bytes = int(np.prod(self.slot_shape))
+        self.jpeg_capacity = int(jpeg_capacity)
+        self.levels = tuple(int(d) for d in levels)
+        if not self.levels or self.levels[0] != 1 or len(self.levels) > MAX_LEVELS:
+            raise ValueError(f"金字塔設定錯誤: {levels}")
+        # 各層容量以無條件進位計算，JPEG 縮放解碼的尺寸也能放入
+        h, w, c = self.slot_shape
+        self.level_bytes = [self.slot_bytes] + [-(-h // d) * -(-w // d) * c for d in self.levels[1:]]
+        # 原始解析度的幀以 build_pyramid 縮小時各層的尺寸
+        self.level_shapes = [self.slot_shape] + [(max(1, h // d), max(1, w // d), c) for d in self.levels[1:]]
+
+        header_bytes = HEADER_WORDS * 8
+        meta_bytes = self.nslots * META_WORDS * 8
+        data_bytes = self.nslots * self.slot_bytes
+        level_bytes = self.nslots * sum(self.level_bytes[1:])
+        total = header_bytes + meta_bytes + data_bytes + self.nslots * self.jpeg_capacity + level_bytes
+
+        self._owner = create
+        self.local = local
+        if local:
+            self.shm = None
+            self.name = None
+            buf = memoryview(bytearray(total))
+        else:
+            if create:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=total)
+            else:
+                self.shm = shared_memory.SharedMemory(name=name, create=False)
+            self.name = self.shm.name
+            buf = self.shm.buf
+        self.header = np.ndarray((HEADER_WORDS,), dtype=np.int64, buffer=buf, offset=0)
+        self.meta = np.ndarray((self.nslots, META_WORDS), dtype=np.int64, buffer=buf, offset=header_bytes)
+        self.data = np.ndarray((self.nslots, self.slot_bytes), dtype=np.uint8, buffer=buf,
+                               offset=header_bytes + meta_bytes)
+        offset = header_bytes + meta_bytes + data_bytes
+        self.jpeg_data = np.ndarray((self.nslots, self.jpeg_capacity), dtype=np.uint8, buffer=buf,
+                                    offset=offset)
+        offset += self.nslots * self.jpeg_capacity
+        self.level_data = [self.data]
+        for nbytes in self.level_bytes[1:]:
+            self.level_data.append(np.ndarray((self.nslots, nbytes), dtype=np.uint8, buffer=buf, offset=offset))
+            offset += self.nslots * nbytes
+        # 同一塊 meta / header 以 float64 解讀，存放浮點欄位
+        self.fmeta = self.meta.view(np.float64)
+        self.fheader = self.header.view(np.float64)
+        if create:
+            self.header[:] = 0
+            self.header[H_LATEST] = -1
+            self.header[H_WAKE_LAT_NS] = -1
+            self.header[H_IDLE_NS] = 5_000_000_000
+            self.meta[:] = 0
+            self.meta[:, M_SEQ] = -1
+
+    def __reduce__(self):
+        # 傳到子進程時以名稱重新連接，而不是複製內容
+        if self.local:
+            raise TypeError("本進程緩衝 (local=True) 不能傳給其他進程")
+        return (SharedFrameRing, (self.name, self.nslots, self.slot_shape, False, self.jpeg_capacity,
+                                  self.levels))
+
+    # ---------- 寫入端 ----------
+    def slot_buffers(self, shape=None):
+        """
+        下一個要寫入的 slot 的緩衝 (原始解析度, [各層縮圖])，供擷取端直接解碼 / 縮小到 slot 中
+        shape: 目前擷取的幀尺寸 (h, w, c)，小於 slot 時 (例如低解析度模式) 回傳該尺寸的 view，預設為 slot 大小
+        取得後即標記為寫入中，之後以 write() 傳入同一批緩衝時不會再複製
+        """
+        idx = (int(self.header[H_LATEST]) + 1) % self.nslots
+        self.meta[idx, M_SEQ] = -1
+        if shape is None or int(np.prod(shape)) > self.slot_bytes:
+            shape = self.slot_shape
+        h, w, c = shape
+        full = self.data[idx, :h * w * c].reshape(shape)
+        levels = []
+        for lv, d in enumerate(self.levels[1:], start=1):
+            lshape = (max(1, h // d), max(1, w // d), c)
+            levels.append(self.level_data[lv][idx, :int(np.prod(lshape))].reshape(lshape))
+        return full, levels
+
+    def write(self, frame: np.ndarray, ts_ns: int = None, motion: float = float('nan'), jpeg=None,
+              levels=None) -> int:
+        """
+        寫入一幀並回傳其序號，超出 slot 容量時回傳 -1
+        frame: 解碼後的像素，只保留 JPEG 時可為 None
+        ts_ns: 擷取時間 (time.monotonic_ns())，未指定時使用目前時間
+        motion: 與前一幀的運動量
+        jpeg: 攝影機原始 JPEG (1-D uint8)，超出容量時不保留
+        levels: 金字塔第 1 層起的縮圖列表，順序對應 self.levels[1:]
+        """
+        if frame is not None and frame.nbytes > self.slot_bytes:
+            return -1
+        if frame is None and jpeg is None and not levels:
+            return -1
+        seq = int(self.header[H_LATEST]) + 1
+        idx = seq % self.nslots
+        meta = self.meta[idx]
+
+        meta[M_SEQ] = -1  # 先標記為寫入中，讀取端會視為無效
+        if frame is not None:
+            h, w = frame.shape[:2]
+            c = frame.shape[2] if frame.ndim == 3 else 1
+            dst = self.data[idx, :frame.nbytes].reshape(frame.shape)
+            if not same_buffer(dst, frame):
+                np.copyto(dst, frame)
+        else:
+            h = w = c = 0
+        jlen = 0
+        if jpeg is not None and 0 < jpeg.size <= self.jpeg_capacity:
+            jlen = jpeg.size
+            self.jpeg_data[idx, :jlen] = jpeg
+        for lv in range(1, len(self.levels)):
+            img = levels[lv - 1] if levels and lv - 1 < len(levels) else None
+            base = M_LVL + 3 * (lv - 1)
+            if img is None or img.nbytes > self.level_bytes[lv]:
+                meta[base:base + 3] = 0
+                continue
+            dst = self.level_data[lv][idx, :img.nbytes].reshape(img.shape)
+            if not same_buffer(dst, img):
+                np.copyto(dst, img)
+            meta[base] = img.shape[0]
+            meta[base + 1] = img.shape[1]
+            meta[base + 2] = img.shape[2] if img.ndim == 3 else 1
+        meta[M_H] = h
+        meta[M_W] = w
+        meta[M_C] = c
+        meta[M_JLEN] = jlen
+        meta[M_TS] = monotonic_ns() if ts_ns is None else ts_ns
+        self.fmeta[idx, M_MOTION] = motion
+        meta[M_SEQ] = seq
+        self.header[H_LATEST] = seq
+        return seq
+
+    # ---------- 擷取需求控制 ----------
+    def touch(self):
+        """讀取端登記需求，擷取進程據此判斷是否閒置"""
+        self.header[H_DEMAND_NS] = monotonic_ns()
+
+    def request_frame(self):
+        """
+        讀取端要求一個新幀，擷取進程只在計數改變後才解碼下一幀
+        多個讀取端同時遞增可能少算，但計數仍會改變，不影響判斷
+        """
+        self.header[H_DEMAND_NS] = monotonic_ns()
+        self.header[H_DEMAND_SEQ] += 1
+
+    def demand_seq(self) -> int:
+        return int(self.header[H_DEMAND_SEQ])
+
+    def set_warm_until(self, until_ns: int):
+        self.header[H_WARM_UNTIL_NS] = until_ns
+
+    def set_idle_timeout(self, seconds: float):
+        self.header[H_IDLE_NS] = int(seconds * 1e9)
+
+    def is_idle(self, now_ns: int = None) -> bool:
+        """超過閒置時間沒有讀取需求，且不在 keep-warm 期間"""
+        now_ns = monotonic_ns() if now_ns is None else now_ns
+        return (now_ns - int(self.header[H_DEMAND_NS]) > int(self.header[H_IDLE_NS])
+                and now_ns > int(self.header[H_WARM_UNTIL_NS]))
+
+    # ---------- 讀取端 ----------
+    def latest_seq(self) -> int:
+        return int(self.header[H_LATEST])
+
+    def is_valid(self, seq: int) -> bool:
+        """檢查序號為 seq 的幀是否仍在緩衝中且未被覆寫"""
+        return seq >= 0 and int(self.meta[seq % self.nslots, M_SEQ]) == seq
+
+    def info(self, seq: int):
+        """取得序號為 seq 的幀資訊，已被覆寫時回傳 None"""
+        if seq < 0:
+            return None
+        idx = seq % self.nslots
+        ts_ns = int(self.meta[idx, M_TS])
+        motion = float(self.fmeta[idx, M_MOTION])
+        has_frame = int(self.meta[idx, M_H]) > 0
+        jlen = int(self.meta[idx, M_JLEN])
+        if not self.is_valid(seq):
+            return None
+        return FrameInfo(seq=seq, ts=ts_ns / 1e9, motion=motion, has_frame=has_frame, jpeg_len=jlen)
+
+    def level_index(self, level: int) -> int:
+        """將金字塔層級 (0 起算) 限制在可用範圍內"""
+        return max(0, min(int(level), len(self.levels) - 1))
+
+    def view(self, seq: int, level: int = 0):
+        """
+        取得序號為 seq 的幀的 zero-copy 唯讀 view，已被覆寫時回傳 None
+        level: 金字塔層級，0 為原始解析度
+        """
+        if seq < 0:
+            return None
+        idx = seq % self.nslots
+        level = self.level_index(level)
+        base = M_H if level == 0 else M_LVL + 3 * (level - 1)
+        h, w, c = (int(x) for x in self.meta[idx, base:base + 3])
+        if not self.is_valid(seq) or h == 0:
+            return None
+        shape = (h, w, c) if c > 1 else (h, w)
+        frame = self.level_data[level][idx, :h * w * c].reshape(shape)
+        frame.flags.writeable = False
+        return frame
+
+    def jpeg(self, seq: int):
+        """取得序號為 seq 的幀的原始 JPEG (bytes 複本)，沒有保留或已被覆寫時回傳 None"""
+        if seq < 0 or self.jpeg_capacity == 0:
+            return None
+        idx = seq % self.nslots
+        jlen = int(self.meta[idx, M_JLEN])
+        if jlen == 0 or not self.is_valid(seq):
+            return None
+        data = self.jpeg_data[idx, :jlen].tobytes()
+        if not self.is_valid(seq):
+            return None
+        return data
+
+    def read(self, seq: int, copy=False, level: int = 0):
+        """
+        讀取序號為 seq 的幀
+        回傳 (info, frame)，已被覆寫時回傳 (None, None)
+        只保留 JPEG 的幀 (info.has_frame 為 False) 回傳 (info, None)
+        copy=True 時回傳複本，並在複製後再次檢查序號，避免複製途中被覆寫
+        """
+        info = self.info(seq)
+        if info is None:
+            return None, None
+        frame = self.view(seq, level)
+        if frame is None:
+            if self.is_valid(seq):
+                return info, None
+            return None, None
+        if copy:
+            frame = frame.copy()
+            if not self.is_valid(seq):
+                return None, None
+        return info, frame
+
+    def read_latest(self, copy=False, level: int = 0):
+        """
+        讀取最新的幀
+        回傳 (info, frame)，沒有幀時回傳 (None, None)，該層級沒有像素時 frame 為 None
+        """
+        for _ in range(self.nslots):
+            seq = self.latest_seq()
+            if seq < 0:
+                break
+            info, frame = self.read(seq, copy=copy, level=level)
+            if info is not None:
+                return info, frame
+        return None, None
+
+    def nearest_seq(self, ts: float):
+        """
+        在緩衝中找擷取時間最接近 ts (秒) 的幀
+        回傳 (seq, |時間差|)，沒有有效幀時回傳 (-1, inf)
+        """
+        ts_ns = ts * 1e9
+        best_seq, best_dt = -1, float('inf')
+        latest = self.latest_seq()
+        for seq in range(max(0, latest - self.nslots + 1), latest + 1):
+            frame_ts = int(self.meta[seq % self.nslots, M_TS])
+            if not self.is_valid(seq):
+                continue
+            dt = abs(frame_ts - ts_ns) / 1e9
+            if dt < best_dt:
+                best_seq, best_dt = seq, dt
+        return best_seq, best_dt
+
+    def latest_ts(self) -> float:
+        """最新一幀的擷取時間 (秒)，尚無幀時回傳 -inf"""
+        info = self.info(self.latest_seq())
+        return info.ts if info is not None else float('-inf')
+
+    def reset(self):
+        self.header[H_LATEST] = -1
+        self.meta[:, M_SEQ] = -1
+
+    def close(self):
+        """釋放共享記憶體，建立者會同時 unlink"""
+        self.header = self.fheader = self.meta = self.fmeta = self.data = self.jpeg_data = None
+        self.level_data = []
+        if self.shm is None:
+            return
+        try:
+            self.shm.close()
+        except BufferError:
+            # 仍有外部持有的 view，交由 GC 處理 mapping
+            pass
+        if self._owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
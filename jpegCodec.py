@@ -0,0 +1,119 @@
+"""
+JPEG 編碼器，安裝了 PyTurboJPEG (libjpeg-turbo) 時優先使用，否則使用 OpenCV
+turbojpeg 為選用相依: pip install PyTurboJPEG，並需要系統的 libturbojpeg (PyTurboJPEG 2.x 需 libjpeg-turbo 3.0 以上)
+
+    encoder = JpegEncoder()                      # auto: turbojpeg -> opencv
+    encoder = JpegEncoder("opencv", subsampling="444")
+    jpeg = encoder.encode(frame, quality=90)     # BGR 或灰階
+    jpeg = encoder.encode_yuv(i420, width, height, quality=90)
+
+subsampling: 色度取樣 "444" / "422" / "420" / "gray"，預設 "420" 與 OpenCV 的預設輸出相同
+fast_dct: 使用較快但精度稍低的整數 DCT，只有 turbojpeg 支援，opencv 忽略此選項
+encode_yuv: 直接編碼 I420 (YUV 4:2:0 planar) 資料，turbojpeg 不需轉換色彩空間；opencv 先轉為 BGR 再編碼
+"""
+from typing import Optional
+
+import cv2
+import numpy as np
+
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+SUBSAMPLINGS = ("444", "422", "420", "gray")
+
+_CV_SAMPLING = {
+    "444": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444,
+    "422": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+    "420": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420,
+}
+
+
+_turbo = None
+
+
+def _turbo_handle():
+    """共用的 TurboJPEG 物件 (每次編碼各自建立 libjpeg-turbo handle，可跨執行緒使用)，找不到函式庫時回傳 None"""
+    global _turbo
+    if _turbo is None and turbojpeg is not None:
+        try:
+            _turbo = turbojpeg.TurboJPEG()
+        except (OSError, RuntimeError):
+            # 有 Python 套件但找不到 libturbojpeg
+            _turbo = False
+    return _turbo or None
+
+
+def available_backends() -> list:
+    """目前環境可用的編碼器後端"""
+    backends = ["opencv"]
+    if _turbo_handle() is not None:
+        backends.insert(0, "turbojpeg")
+    return backends
+
+
+class JpegEncoder:
+    def __init__(self, backend: str = "auto", subsampling: str = "420", fast_dct: bool = False):
+        if subsampling not in SUBSAMPLINGS:
+            raise ValueError(f"未知的色度取樣: {subsampling}")
+        if backend == "auto":
+            backend = available_backends()[0]
+        elif backend not in ("turbojpeg", "opencv"):
+            raise ValueError(f"未知的 JPEG 編碼器: {backend}")
+        elif backend == "turbojpeg" and _turbo_handle() is None:
+            raise RuntimeError("未安裝 PyTurboJPEG 或找不到 libturbojpeg")
+        self.backend = backend
+        self.subsampling = subsampling
+        self.fast_dct = fast_dct
+
+    def __repr__(self):
+        return f"JpegEncoder({self.backend}, {self.subsampling}, fast_dct={self.fast_dct})"
+
+    def encode(self, frame: np.ndarray, quality: int = 90, subsampling: Optional[str] = None) -> Optional[bytes]:
+        """編碼 BGR 或灰階影像，subsampling 可覆寫預設值，失敗回傳 None"""
+        subsampling = subsampling or self.subsampling
+        gray = frame.ndim == 2 or frame.shape[2] == 1
+        if self.backend == "turbojpeg":
+            tj = turbojpeg
+            if gray:
+                pixel_format, samp = tj.TJPF_GRAY, tj.TJSAMP_GRAY
+            else:
+                pixel_format, samp = tj.TJPF_BGR, self._turbo_sampling(subsampling)
+            if not frame.flags.c_contiguous:
+                frame = np.ascontiguousarray(frame)
+            return _turbo_handle().encode(frame, quality=int(quality), pixel_format=pixel_format,
+                                          jpeg_subsample=samp, flags=self._turbo_flags())
+        if subsampling == "gray" and not gray:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+        if subsampling in _CV_SAMPLING:
+            params += [int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR), int(_CV_SAMPLING[subsampling])]
+        ret, buffer = cv2.imencode('.jpg', frame, params)
+        return buffer.tobytes() if ret else None
+
+    def encode_yuv(self, yuv: np.ndarray, width: int, height: int, quality: int = 90) -> Optional[bytes]:
+        """
+        編碼 I420 資料 (Y 平面後接 U、V 平面，共 width * height * 3 / 2 bytes)
+        輸出的色度取樣固定為 4:2:0
+        libjpeg-turbo 預設每列對齊 4 bytes，寬度為 8 的倍數時與緊密排列的 I420 相同，其他寬度改走 OpenCV 轉換
+        """
+        yuv = np.ascontiguousarray(yuv).reshape(-1)
+        if self.backend == "turbojpeg" and width % 8 == 0:
+            return _turbo_handle().encode_from_yuv(yuv, height, width, quality=int(quality),
+                                                   jpeg_subsample=turbojpeg.TJSAMP_420,
+                                                   flags=self._turbo_flags())
+        bgr = cv2.cvtColor(yuv.reshape(height * 3 // 2, width), cv2.COLOR_YUV2BGR_I420)
+        return self.encode(bgr, quality, "420")
+
+    @staticmethod
+    def _turbo_sampling(subsampling: str) -> int:
+        return {
+            "444": turbojpeg.TJSAMP_444,
+            "422": turbojpeg.TJSAMP_422,
+            "420": turbojpeg.TJSAMP_420,
+            "gray": turbojpeg.TJSAMP_GRAY,
+        }[subsampling]
+
+    def _turbo_flags(self) -> int:
+        return turbojpeg.TJFLAG_FASTDCT if self.fast_dct else 0
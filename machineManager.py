@@ -2,18 +2,27 @@ from dataclasses import dataclass, asdict
 from copy import deepcopy
 from enum import Enum
 import asyncio
+import contextlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import base64, json
 import traceback
-from typing import Dict, List, Optional, Tuple
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 import time
 from pathlib import Path
 import sys, os
 
 import cv2
+import numpy as np
 from loguru import logger
 import pynng
 
-from utils import DualMotorPathOptimizer, spDict_to_pathList, VideoCaptureProcess
+from utils import DualMotorPathOptimizer, spDict_to_pathList, VideoCaptureProcess, CAPTURE_BACKENDS
+from cameraService import CameraService, ServiceCamera
+from jpegCodec import JpegEncoder
+from scanComposite import build_composite
+from frameAnalysis import merge_burst, sharpness, downscale_gray, UndistortMapCache, RoiDetector, PresenceDetector
 
 class MachineState(Enum):
     IDLE = 0
@@ -53,7 +62,55 @@ class MotorData:
     pos:float = 0
     spd:float = 0
     state:str = "IDLE"
-    
+
+
+class MotorPoseHistory:
+    """
+    單一馬達位置與速度的時間序列 (time.monotonic() 秒)，固定長度的環狀緩衝
+    以線性內插取得任意時間點 (例如幀的擷取時間) 的位置，晚於最後一筆且仍在移動時以最後兩筆外插
+    """
+    def __init__(self, capacity: int = 4096, max_extrapolate: float = 0.2):
+        self.capacity = capacity
+        self.max_extrapolate = max_extrapolate
+        self._data = np.zeros((capacity, 3), np.float64)
+        self._count = 0
+
+    def append(self, ts: float, pos: float, spd: float):
+        self._data[self._count % self.capacity] = (ts, pos, spd)
+        self._count += 1
+
+    def _ordered(self) -> np.ndarray:
+        if self._count <= self.capacity:
+            return self._data[:self._count]
+        return np.roll(self._data, -(self._count % self.capacity), axis=0)
+
+    def pose_at(self, ts: float) -> Optional[dict]:
+        """
+        回傳 {"pos", "spd", "method", "gap"}，沒有資料時回傳 None
+        method: interp (前後兩筆內插)、extrap (最後兩筆外插)、hold (沿用最近一筆)
+        gap: 與最近一筆資料的時間差 (秒)
+        """
+        data = self._ordered()
+        if len(data) == 0:
+            return None
+        t, pos, spd = data[:, 0], data[:, 1], data[:, 2]
+        i = int(np.searchsorted(t, ts))
+        gap = float(np.min(np.abs(t[max(i - 1, 0):i + 1] - ts)))
+        if 0 < i < len(t):
+            method = "interp"
+            p, s = np.interp(ts, t, pos), np.interp(ts, t, spd)
+        elif (i == len(t) and len(t) >= 2 and ts - t[-1] <= self.max_extrapolate and t[-1] > t[-2]
+              and spd[-1] != 0):
+            # 回報速度為 0 (靜止) 時不外插
+            method = "extrap"
+            p = pos[-1] + (pos[-1] - pos[-2]) / (t[-1] - t[-2]) * (ts - t[-1])
+            s = spd[-1]
+        else:
+            method = "hold"
+            j = min(i, len(t) - 1)
+            p, s = pos[j], spd[j]
+        return {"pos": round(float(p), 3), "spd": round(float(s), 3), "method": method, "gap": round(gap, 4)}
+
 
 class MachineManager:
     """
@@ -63,6 +120,10 @@ class MachineManager:
     def __init__(self, 
                  camera_configs: List[dict],
                  motor0_home_pos = 30, motor1_home_pos = 330,
+                 calibration: Optional[dict] = None,
+                 sync_max_skew: float = 0.04,
+                 jpeg: Optional[dict] = None,
+                 composite: Optional[dict] = None,
                  cmd_addr: str = "tcp://127.0.0.1:8780" if sys.platform.startswith("win") else "ipc:///tmp/pico_cmd",
                  stat_addr: str = "tcp://127.0.0.1:8781" if sys.platform.startswith("win") else "ipc:///tmp/pico_stat"):
         
@@ -83,12 +144,50 @@ class MachineManager:
         # self.camera_list: Dict[str, cv2.VideoCapture] = {}
         self.camera_list: Dict[str, VideoCaptureProcess] = {}
         self.camera_locks: Dict[str, asyncio.Lock] = {}
+        # 攝像頭監控: 無新幀超過此秒數視為停滯，重啟間隔以指數退避
+        self.camera_stall_deadline = 3.0
+        self.camera_restart_backoff = {}
+        self.camera_next_restart = {}
+        # 每個攝像頭的連拍設定: 張數與合併方式 ("mean" / "median")
+        self.camera_burst: Dict[str, Tuple[int, str]] = {}
+        # 每個攝像頭的清晰度門檻與重拍次數，門檻為 None 時只計算分數不重拍
+        self.camera_sharpness: Dict[str, Tuple[Optional[float], int]] = {}
+        # 掃描回傳的預覽圖縮小比例，完整品質的圖片只寫入檔案
+        self.camera_preview_scale: Dict[str, float] = {}
+        # 設定 "roi": True 的攝像頭存檔前裁切到工件範圍，背景模型保存在 roi_dir
+        self.roi_dir = "roiBackground"
+        self.camera_roi: Dict[str, RoiDetector] = {}
+        # 最近一次掃描每張圖的資訊 (清晰度等)，與回傳的圖片順序相同
+        self.scan_meta: Dict[str, List[dict]] = {}
+        # 鏡頭畸變校正 (camData.json)，設定 "undistort": True 的攝像頭才會在存檔前校正
+        self.calibration = calibration
+        self.camera_undistort: Dict[str, UndistortMapCache] = {}
+        # 同步拍照允許的最大時間差 (秒)
+        self.sync_max_skew = sync_max_skew
+        # 存檔、預覽與串流共用的 JPEG 編碼器，jpeg 為 JpegEncoder 的參數 (backend, subsampling, fast_dct)
+        self.jpeg_encoder = JpegEncoder(**(jpeg or {}))
+        logger.info(f"JPEG 編碼器: {self.jpeg_encoder}")
+        # 掃描後的 360° 合成圖參數 (height, quality, label)，None 為不建立；在獨立的進程池中執行
+        self.composite = composite
+        self._composite_pool: Optional[ProcessPoolExecutor] = None
+        # 設定 "presence" 的攝像頭以低解析度預覽偵測工件放置，背景模型同樣保存在 roi_dir
+        # 偵測期間攝像頭以 presence_interval 的頻率持續取幀，不會進入閒置
+        self.camera_presence: Dict[str, PresenceDetector] = {}
+        self.presence_interval = 0.25
+        self.auto_scan = True
+        # 掃描觸發 (shot 按鈕或工件放置) 時執行的回呼，參數為觸發來源，由 app 設定
+        self.scan_callback: Optional[Callable[[str], Awaitable]] = None
+        self._scan_task: Optional[asyncio.Task] = None
+        # 手動與觸發的掃描共用，掃描序列 (含清理 motorImage) 執行期間持有，同一時間只有一趟掃描
+        self.scan_lock = asyncio.Lock()
         
         # 按鈕狀態 (供前端查詢)
         self.buttons = ButtonState()
         
         # 馬達狀態
         self.motor_data = [MotorData(id=id) for id in range(2)]
+        # 馬達狀態的時間序列，用來內插每張圖擷取當下的實際位置
+        self.motor_history = [MotorPoseHistory() for _ in range(2)]
         self.motor0_home_pos = motor0_home_pos
         self.motor1_home_pos = motor1_home_pos
         self.motors_home_pos = [motor0_home_pos, motor1_home_pos]
@@ -96,15 +195,36 @@ class MachineManager:
         # 限位開關狀態
         self.limitSwitchs = [False for _ in range(2)]
         
+        # backend 為 "service" 的攝像頭共用一個擷取進程，全部建立後才啟動
+        self.camera_service: Optional[CameraService] = None
         # 初始化攝像頭
         for cfg in camera_configs:
             self._init_camera(cfg)
+        if self.camera_service is not None:
+            self.camera_service.start()
     
     def _init_camera(self, config: dict):
         """初始化攝像頭並設定參數"""
         try:
             # cap = cv2.VideoCapture(config["dev"])
-            cap = VideoCaptureProcess(config["dev"])
+            # backend: "process" 子進程擷取 (預設)，"thread" 本進程執行緒擷取，
+            # "service" 所有攝像頭共用一個擷取進程
+            backend = config.get("backend", "process")
+            kwargs = dict(settle_threshold=config.get("settle_threshold"),
+                          capture_mode=config.get("capture_mode", "bgr"),
+                          pyramid=tuple(config.get("pyramid", (1, 2, 4))),
+                          idle_timeout=config.get("idle_timeout", 5.0),
+                          lazy_decode=config.get("lazy_decode", True),
+                          exposure=config.get("exposure", 150),
+                          auto_exposure=config.get("auto_exposure"),
+                          jpeg_encoder=self.jpeg_encoder,
+                          sensor_modes=config.get("sensor_modes"))
+            if backend == "service":
+                if self.camera_service is None:
+                    self.camera_service = CameraService()
+                cap = ServiceCamera(self.camera_service, config["name"], config["dev"], **kwargs)
+            else:
+                cap = CAPTURE_BACKENDS[backend](config["dev"], **kwargs)
             # if not cap.isOpened():
             #     logger.error(f"無法打開攝像頭 {config['name']}")
             #     return
@@ -113,6 +233,40 @@ class MachineManager:
             # 存儲攝像頭和對應的鎖
             self.camera_list[config["name"]] = cap
             self.camera_locks[config["name"]] = asyncio.Lock()
+            self.camera_burst[config["name"]] = (int(config.get("burst", 1)), config.get("burst_method", "mean"))
+            self.camera_sharpness[config["name"]] = (config.get("sharpness_threshold"),
+                                                     int(config.get("sharpness_retries", 3)))
+            self.camera_preview_scale[config["name"]] = float(config.get("preview_scale", 0.5))
+            if config.get("undistort") and self.calibration is not None:
+                undistorter = UndistortMapCache(self.calibration["camera_matrix"],
+                                                self.calibration["distortion_coefficients"],
+                                                self.calibration.get("image_size"))
+                capture_size = cap.sensor_modes["capture"][:2]
+                if not undistorter.supports(capture_size):
+                    # 內參與擷取解析度對不上時校正結果是錯的，寧可不校正
+                    logger.error(f"攝像頭 {config['name']} 擷取解析度 {capture_size[0]}x{capture_size[1]} "
+                                 f"與標定尺寸 {undistorter.calib_size} 不符 (或未記錄 image_size)，不做畸變校正")
+                else:
+                    # 啟動時先建立擷取解析度的查表
+                    undistorter.get_maps(capture_size)
+                    self.camera_undistort[config["name"]] = undistorter
+            if config.get("roi"):
+                detector = RoiDetector()
+                bg_path = os.path.join(self.roi_dir, f"{config['name']}.npz")
+                if os.path.exists(bg_path):
+                    detector.load(bg_path)
+                else:
+                    logger.warning(f"攝像頭 {config['name']} 尚未建立空機台背景，暫不裁切")
+                self.camera_roi[config["name"]] = detector
+            if config.get("presence"):
+                params = config["presence"] if isinstance(config["presence"], dict) else {}
+                presence = PresenceDetector(**params)
+                bg_path = os.path.join(self.roi_dir, f"{config['name']}_presence.npz")
+                if os.path.exists(bg_path):
+                    presence.load(bg_path)
+                else:
+                    logger.warning(f"攝像頭 {config['name']} 尚未建立空轉盤背景，暫不偵測工件")
+                self.camera_presence[config["name"]] = presence
             logger.info(f"攝像頭 {config['name']} 初始化成功")
         except Exception as e:
             logger.error(f"攝像頭 {config['name']} 初始化失敗: {e}")
@@ -141,6 +295,15 @@ class MachineManager:
             btnMoni_task = asyncio.create_task(self._btnMoniTask())
             self._tasks.append(btnMoni_task)
             
+            # 攝像頭監控任務
+            camSup_task = asyncio.create_task(self._camera_supervisor())
+            self._tasks.append(camSup_task)
+
+            # 工件放置偵測任務
+            if self.camera_presence:
+                presence_task = asyncio.create_task(self._presence_monitor())
+                self._tasks.append(presence_task)
+            
             logger.info("MachineManager 已啟動")
             
             # 發送初始化命令，設置綠燈
@@ -165,8 +328,15 @@ class MachineManager:
                     pass
         
         self._tasks.clear()
+        if self._scan_task is not None and not self._scan_task.done():
+            self._scan_task.cancel()
+        if self._composite_pool is not None:
+            self._composite_pool.shutdown(wait=False, cancel_futures=True)
+            self._composite_pool = None
         
-        # 釋放攝像頭資源
+        # 釋放攝像頭資源，共用的擷取進程一次停止所有攝像頭
+        if self.camera_service is not None:
+            self.camera_service.stop()
         for name, cap in self.camera_list.items():
             # cap.release()
             cap.stop()
@@ -207,11 +377,14 @@ class MachineManager:
         """處理從下位機接收的狀態數據"""
         # 處理馬達狀態
         if "m" in data and isinstance(data["m"], list):
+            # 以收到的時間作為狀態時間，與幀的擷取時間同一個時鐘
+            now = time.monotonic()
             for i, motor in enumerate(data["m"]):
                 if i < len(self.motor_data):
                     self.motor_data[i].pos = motor.get("pos", 0)
                     self.motor_data[i].spd = motor.get("spd", 0)
                     self.motor_data[i].state = motor.get("state", "IDLE")
+                    self.motor_history[i].append(now, self.motor_data[i].pos, self.motor_data[i].spd)
         
         # 處理按鈕狀態
         if "btn" in data and isinstance(data["btn"], list):
@@ -246,7 +419,7 @@ class MachineManager:
                     if motor.state == "ERROR":
                         await self._handle_error(f"馬達 {i} 錯誤")
                 
-                # 檢查攝像頭錯誤
+                # 檢查攝像頭錯誤 (擷取進程的偵測與重啟由 _camera_supervisor 處理)
                 for name, cap in self.camera_list.items():
                     pass
                     # if not cap.isOpened():
@@ -267,6 +440,154 @@ class MachineManager:
                 logger.error(f"{traceback.format_exc()}")
                 await asyncio.sleep(1)  # 出錯後等待較長時間
     
+    async def _camera_supervisor(self):
+        """監控擷取進程，進程結束或擷取停滯時以指數退避重新啟動"""
+        while self._is_running:
+            try:
+                now = time.monotonic()
+                for name, cap in list(self.camera_list.items()):
+                    stalled = cap.stalled_for()
+                    if cap.is_alive() and stalled < self.camera_stall_deadline:
+                        # 恢復正常出幀一段時間後重置退避時間
+                        if cap.restart_count and now - cap.last_restart > 30:
+                            self.camera_restart_backoff[name] = 0
+                        continue
+                    if now < self.camera_next_restart.get(name, 0):
+                        continue
+                    reason = "進程已結束" if not cap.is_alive() else f"{stalled:.1f}s 沒有新幀"
+                    backoff = min(max(self.camera_restart_backoff.get(name, 0) * 2, 1), 30)
+                    self.camera_restart_backoff[name] = backoff
+                    self.camera_next_restart[name] = now + backoff
+                    logger.warning(f"攝像頭 {name} {reason}，重新啟動 (下次最快 {backoff}s 後)")
+                    await asyncio.to_thread(cap.restart)
+                await asyncio.sleep(0.5)
+            except Exception as e:
+                logger.error(f"攝像頭監控任務出錯: {e}")
+                await asyncio.sleep(1)
+
+    def is_scanning(self) -> bool:
+        """有掃描正在執行 (持有 scan_lock) 或已觸發但尚未開始"""
+        return self.scan_lock.locked() or (self._scan_task is not None and not self._scan_task.done())
+
+    def trigger_scan(self, source: str) -> bool:
+        """
+        以背景任務執行 scan_callback，不阻塞按鈕與偵測迴圈
+        機台非 IDLE 或已有掃描 (手動或觸發) 在執行時忽略，回傳是否已開始
+        """
+        if self.scan_callback is None:
+            logger.warning(f"掃描觸發 ({source}) 未設定回呼，忽略")
+            return False
+        if self._state != MachineState.IDLE or self.is_scanning():
+            logger.info(f"掃描觸發 ({source}) 時機台忙碌中，忽略")
+            return False
+        logger.info(f"掃描觸發: {source}")
+        self._scan_task = asyncio.create_task(self._run_scan(source))
+        return True
+
+    async def _run_scan(self, source: str):
+        try:
+            await self.scan_callback(source)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"觸發的掃描 ({source}) 失敗: {e}")
+            logger.error(traceback.format_exc())
+
+    async def _presence_monitor(self):
+        """在最小的金字塔層級偵測工件放置，新工件靜止後觸發掃描"""
+        while self._is_running:
+            try:
+                busy = self._state != MachineState.IDLE or self.is_scanning()
+                for name, detector in self.camera_presence.items():
+                    if not detector.ready or not self.auto_scan:
+                        continue
+                    if busy:
+                        # 掃描中 (包含手動掃描) 的工件不再觸發，取走後才重新偵測
+                        detector.hold()
+                        continue
+                    cap = self.camera_list[name]
+                    ret, frame = cap.read(level=len(cap.frame_ring.levels) - 1)
+                    if not ret:
+                        continue
+                    if detector.update(downscale_gray(frame), time.monotonic()):
+                        logger.info(f"{name} 偵測到工件放置 (前景 {detector.fill:.1%})")
+                        if self.trigger_scan(f"presence:{name}"):
+                            for other in self.camera_presence.values():
+                                other.hold()
+                        break
+                await asyncio.sleep(self.presence_interval)
+            except Exception as e:
+                logger.error(f"工件偵測任務出錯: {e}")
+                await asyncio.sleep(1)
+
+    def get_presence_status(self) -> dict:
+        """各攝像頭的工件偵測狀態與前景比例"""
+        return {
+            "auto_scan": self.auto_scan,
+            "scanning": self.is_scanning(),
+            "cameras": {
+                name: {"ready": d.ready, "state": d.state, "fill": round(d.fill, 4)}
+                for name, d in self.camera_presence.items()
+            },
+        }
+
+    async def build_scan_composites(self, scan_meta: Optional[Dict[str, List[dict]]] = None) -> Dict[str, dict]:
+        """
+        在進程池中為每個攝像頭建立 360° 合成圖 (見 scanComposite)，預設使用最近一次掃描的 scan_meta
+        角度取自每張圖擷取當下內插的馬達位置，沒有近期的馬達資料時使用目標位置
+        回傳 {攝像頭: 合成圖資訊與 base64 圖片 "image"}，未啟用時回傳空 dict
+        """
+        if self.composite is None:
+            return {}
+        scan_meta = self.scan_meta if scan_meta is None else scan_meta
+        if self._composite_pool is None:
+            # 事件迴圈所在進程有多個執行緒，以 spawn 建立工作進程
+            self._composite_pool = ProcessPoolExecutor(max_workers=max(1, len(self.camera_list)),
+                                                       mp_context=mp.get_context("spawn"))
+        save_dir = "motorImage"
+        loop = asyncio.get_running_loop()
+        jobs = {}
+        for cam, metas in scan_meta.items():
+            paths, angles = [], []
+            for meta in metas:
+                if not meta.get("file"):
+                    continue
+                pose = (meta.get("pose") or {}).get(f"motor{meta.get('motor')}")
+                angles.append(pose["pos"] if pose and pose["gap"] < 0.5 else float(meta["position"]))
+                paths.append(os.path.join(save_dir, meta["file"]))
+            if paths:
+                out_path = os.path.join(save_dir, f"composite_{cam}.jpg")
+                jobs[cam] = loop.run_in_executor(
+                    self._composite_pool, build_composite, paths, angles, out_path,
+                    int(self.composite.get("height", 360)), int(self.composite.get("quality", 85)),
+                    bool(self.composite.get("label", True)), self.jpeg_encoder)
+        composites = {}
+        for cam, result in zip(jobs, await asyncio.gather(*jobs.values(), return_exceptions=True)):
+            if isinstance(result, BrokenProcessPool) and self._composite_pool is not None:
+                # 工作進程異常結束，下次重新建立進程池
+                self._composite_pool.shutdown(wait=False, cancel_futures=True)
+                self._composite_pool = None
+            if isinstance(result, Exception) or result is None:
+                logger.error(f"{cam} 合成圖建立失敗: {result}")
+                continue
+            # 工作進程只回傳路徑與數值，圖片由已寫入的檔案讀回
+            result["image"] = await asyncio.to_thread(self._read_b64, os.path.join(save_dir, result["file"]))
+            composites[cam] = result
+        return composites
+
+    @staticmethod
+    def _read_b64(path: str) -> str:
+        with open(path, "rb") as f:
+            return base64.b64encode(f.read()).decode('utf-8')
+
+    def motor_pose_at(self, ts: float) -> Dict[str, Optional[dict]]:
+        """各馬達在 ts (time.monotonic() 秒) 的位置與速度，見 MotorPoseHistory.pose_at"""
+        return {f"motor{i}": history.pose_at(ts) for i, history in enumerate(self.motor_history)}
+
+    def is_camera_healthy(self, camera_name: str) -> bool:
+        cap = self.camera_list.get(camera_name)
+        return cap is not None and cap.is_alive() and cap.stalled_for() < self.camera_stall_deadline
+
     async def _lamp_controller(self):
         """控制三色燈的異步任務"""
         prev_state = None
@@ -316,6 +637,11 @@ class MachineManager:
                     tg.create_task(self.motor_move_abs(1, self.motor1_home_pos))
                     
             
+            if all([btnStatePrev.shot == False,
+                    btnStateNow.shot == True]):
+                print("shot button activate")
+                self.trigger_scan("button")
+
             if all([btnStatePrev.resolve == False,
                     btnStateNow.resolve == True]):
                 print("resolve button activate")
@@ -326,7 +652,9 @@ class MachineManager:
                 print("emergency button activate")
                 # self.trigger_emergency()
                 self._handle_error("警急按鈕觸發錯誤")
-                
+
+            # 只在按下的瞬間 (上升緣) 觸發，按住不放不重複觸發
+            btnStatePrev = btnStateNow
             await asyncio.sleep(0.05)
                 
     
@@ -406,11 +734,23 @@ class MachineManager:
     
         
     
-    async def capture_image(self, camera_name: str, position_index:float) -> Optional[Tuple[bool, bytes]]:
-        """捕獲指定攝像頭的圖像"""
+    async def capture_image(self, camera_name: str, position_index:float, after_ts: Optional[float] = None,
+                            burst: Optional[int] = None,
+                            motor_id: Optional[int] = None) -> Optional[Tuple[bool, bytes, dict]]:
+        """
+        捕獲指定攝像頭的圖像
+        after_ts: 只接受擷取時間晚於此時間 (time.monotonic()) 的幀，預設為呼叫當下
+        會等待畫面穩定後才擷取，逾時則使用最新的一幀
+        清晰度低於攝像頭門檻時從緩衝中取後續的幀重拍，用完重拍次數則保留分數最高的一幀
+        burst: 穩定後連拍張數，大於 1 時合併降噪，預設使用攝像頭設定
+        motor_id: 拍攝時轉動工件的馬達，記錄在圖片資訊的 motor 欄位 (與 pose 對應)
+        回傳 (True, base64 圖片, 圖片資訊)，圖片資訊包含清晰度 sharpness 與重拍次數 retakes
+        """
         if camera_name not in self.camera_list:
             logger.error(f"未找到攝像頭: {camera_name}")
             return None
+        if after_ts is None:
+            after_ts = time.monotonic()
         # 確保圖片保存目錄存在
         save_dir = "motorImage"
         os.makedirs(save_dir, exist_ok=True)
@@ -424,26 +764,209 @@ class MachineManager:
             #     logger.error(f"攝像頭 {camera_name} 未打開")
             #     return None
             print("start shot")
-            for i in range(5):
-                ret, frame = cap.read()
-                if ret:
-                    break
+            # 存檔與編碼耗時較長，取複本避免期間被擷取進程覆寫
+            ret, frame, info, settled = await cap.aread_settled(after_ts, timeout=2.0, copy=True)
             print("end shot")
             if not ret:
                 logger.error(f"從攝像頭 {camera_name} 讀取圖像失敗")
                 return None
-            
-            # 保存原始圖片
-            save_path = f'{save_dir}/{camera_name}_{position_index}.jpg'
-            cv2.imwrite(save_path, frame)
-            
-            # 壓縮圖像以便傳輸
-            ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
-            if not ret:
-                logger.error(f"壓縮圖像失敗: {camera_name}")
+            if settled:
+                logger.debug(f"{camera_name} 穩定耗時 {info.ts - after_ts:.3f}s")
+            else:
+                logger.warning(f"{camera_name} 等待畫面穩定逾時，運動量 {info.motion:.2f}")
+
+            frame, info, score, retakes = await self._retake_until_sharp(camera_name, frame, info)
+            meta = {"sharpness": score, "retakes": retakes}
+            if motor_id is not None:
+                meta["motor"] = motor_id
+            return await self._finish_capture(camera_name, position_index, frame, info, burst, meta=meta)
+
+    async def _retake_until_sharp(self, camera_name: str, frame, info):
+        """
+        清晰度未達門檻時依序檢查後續的幀，清晰度在工作執行緒中計算
+        回傳 (frame, info, 清晰度, 重拍次數)
+        """
+        threshold, retries = self.camera_sharpness.get(camera_name, (None, 0))
+        score = await asyncio.to_thread(sharpness, frame)
+        if threshold is None or score >= threshold:
+            return frame, info, score, 0
+        cap = self.camera_list[camera_name]
+        best = (score, frame, info)
+        retakes = 0
+        while retakes < retries and best[0] < threshold:
+            frames, infos = await cap.aread_burst(info.seq, 1, timeout=0.5)
+            if not frames:
+                break
+            retakes += 1
+            frame, info = frames[0], infos[0]
+            score = await asyncio.to_thread(sharpness, frame)
+            if score > best[0]:
+                best = (score, frame, info)
+        score, frame, info = best
+        if score < threshold:
+            logger.warning(f"{camera_name} 重拍 {retakes} 次後清晰度 {score:.1f} 仍低於門檻 {threshold}")
+        else:
+            logger.debug(f"{camera_name} 重拍 {retakes} 次，清晰度 {score:.1f}")
+        return frame, info, score, retakes
+
+    async def _finish_capture(self, camera_name: str, position_index, frame, info,
+                              burst: Optional[int] = None, meta: Optional[dict] = None,
+                              save_dir: str = "motorImage") -> Optional[Tuple[bool, bytes, dict]]:
+        """
+        擷取後的共用流程: 連拍合併、畸變校正、存檔、壓縮成 base64
+        呼叫端需持有該攝像頭的鎖
+        meta: 附加在回傳圖片資訊中的欄位，沒有清晰度時在此計算
+        """
+        cap = self.camera_list[camera_name]
+        burst_count, burst_method = self.camera_burst.get(camera_name, (1, "mean"))
+        if burst is not None:
+            burst_count = burst
+        processed = False
+        if burst_count > 1:
+            # 穩定後的連續幀在工作執行緒中合併，不阻塞事件迴圈
+            frames, _ = await cap.aread_burst(info.seq, burst_count - 1)
+            if frames:
+                frame = await asyncio.to_thread(merge_burst, [frame] + frames, burst_method)
+                processed = True
+                logger.debug(f"{camera_name} 連拍合併 {len(frames) + 1} 張 ({burst_method})")
+        
+        # 鏡頭畸變校正 (查表已在啟動時建立，這裡只做 remap)
+        undistorter = self._undistorter_for(camera_name, frame)
+        if undistorter is not None:
+            frame = await asyncio.to_thread(undistorter.remap, frame)
+            processed = True
+
+        # 裁切到工件範圍，存檔與上傳都只包含裁切後的區域
+        meta = dict(meta or {})
+        detector = self.camera_roi.get(camera_name)
+        if detector is not None and detector.ready:
+            roi = await asyncio.to_thread(detector.find_roi, frame)
+            if roi is not None:
+                x, y, w, h = roi
+                frame = frame[y:y + h, x:x + w]
+                processed = True
+            meta["roi"] = list(roi) if roi is not None else None
+
+        # 存檔與預覽圖在工作執行緒中完成，有攝影機原始 JPEG 時直接寫入，不重新編碼
+        save_path = f'{save_dir}/{camera_name}_{position_index}.jpg'
+        raw_jpeg = cap.frame_ring.jpeg(info.seq) if info.jpeg_len and not processed else None
+        jpegb64, score = await asyncio.to_thread(self._save_and_preview, frame, save_path, raw_jpeg,
+                                                 self.camera_preview_scale.get(camera_name, 0.5),
+                                                 "sharpness" not in meta, self.jpeg_encoder)
+        if jpegb64 is None:
+            logger.error(f"壓縮圖像失敗: {camera_name}")
+            return None
+        if score is not None:
+            meta["sharpness"] = score
+        meta.update({"camera": camera_name, "position": position_index, "ts": info.ts,
+                     "file": os.path.basename(save_path), "pose": self.motor_pose_at(info.ts)})
+        # 圖片資訊另存為同名的 JSON 檔
+        await asyncio.to_thread(self._write_sidecar, save_path, meta)
+        return (True, jpegb64, meta)
+
+    def _undistorter_for(self, camera_name: str, frame) -> Optional[UndistortMapCache]:
+        """攝像頭的畸變校正查表，未啟用或幀的長寬比與標定尺寸不同時回傳 None (記錄錯誤，不校正)"""
+        undistorter = self.camera_undistort.get(camera_name)
+        if undistorter is None:
+            return None
+        h, w = frame.shape[:2]
+        if not undistorter.supports((w, h)):
+            logger.error(f"{camera_name} 幀解析度 {w}x{h} 與標定尺寸 {undistorter.calib_size} 不符，略過畸變校正")
+            return None
+        return undistorter
+
+    @staticmethod
+    def _write_sidecar(image_path: str, meta: dict):
+        with open(os.path.splitext(image_path)[0] + ".json", "w") as f:
+            json.dump(meta, f)
+
+    @staticmethod
+    def _save_and_preview(frame, save_path: str, raw_jpeg: Optional[bytes], preview_scale: float,
+                          score: bool, encoder: JpegEncoder):
+        """
+        完整品質的 JPEG 只編碼一次 (或直接使用攝影機原始 JPEG) 並寫入檔案，
+        回傳用的預覽圖由縮小後的同一幀編碼
+        回傳 (預覽圖 base64, 清晰度)，score 為 False 時清晰度為 None，編碼失敗時預覽圖為 None
+        """
+        if raw_jpeg is None:
+            raw_jpeg = encoder.encode(frame, 95)
+            if raw_jpeg is None:
+                return None, None
+        with open(save_path, 'wb') as f:
+            f.write(raw_jpeg)
+
+        preview = frame
+        if 0 < preview_scale < 1:
+            h, w = frame.shape[:2]
+            size = (max(1, round(w * preview_scale)), max(1, round(h * preview_scale)))
+            preview = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        buffer = encoder.encode(preview, 50)
+        if buffer is None:
+            return None, None
+        jpegb64 = base64.b64encode(buffer).decode('utf-8')
+        return jpegb64, sharpness(frame) if score else None
+
+    async def capture_synchronized(self, camera_names: List[str], position_index="sync",
+                                   after_ts: Optional[float] = None, max_skew: Optional[float] = None,
+                                   attempts: int = 3, save_dir: str = "syncImage") -> Optional[dict]:
+        """
+        多個攝像頭同時拍照
+        各攝像頭先等待畫面穩定，以最晚穩定的時間為參考時間，再從各自的緩衝中挑擷取時間最接近的一幀
+        max_skew: 允許的最大時間差 (秒)，預設為 sync_max_skew，超過時以新的參考時間重試 attempts 次
+        save_dir: 存檔目錄，預設與掃描的 motorImage 分開，不會被掃描清除或一起上傳
+        回傳 {"images": {攝像頭: base64}, "skew": 時間差, "offsets": {攝像頭: 與參考時間的差}}，
+        "meta": {攝像頭: 圖片資訊}，失敗或時間差始終超過上限時回傳 None
+        """
+        for name in camera_names:
+            if name not in self.camera_list:
+                logger.error(f"未找到攝像頭: {name}")
                 return None
-            jpegb64 = base64.b64encode(buffer).decode('utf-8')
-            return (True, jpegb64)
+        if after_ts is None:
+            after_ts = time.monotonic()
+        if max_skew is None:
+            max_skew = self.sync_max_skew
+        os.makedirs(save_dir, exist_ok=True)
+        caps = [self.camera_list[name] for name in camera_names]
+
+        async with contextlib.AsyncExitStack() as stack:
+            # 固定順序取得鎖，避免與其他同步拍照互相等待
+            for name in sorted(camera_names):
+                await stack.enter_async_context(self.camera_locks[name])
+
+            settled = await asyncio.gather(*(cap.aread_settled(after_ts, timeout=2.0) for cap in caps))
+            if not all(ret for ret, _, _, _ in settled):
+                logger.error(f"同步拍照讀取圖像失敗: {camera_names}")
+                return None
+            ref_ts = max(info.ts for _, _, info, _ in settled)
+
+            for attempt in range(attempts):
+                picks = await asyncio.gather(*(cap.aread_nearest(ref_ts, timeout=1.0, copy=True) for cap in caps))
+                if not all(ret for ret, _, _ in picks):
+                    logger.error(f"同步拍照讀取圖像失敗: {camera_names}")
+                    return None
+                stamps = [info.ts for _, _, info in picks]
+                skew = max(stamps) - min(stamps)
+                if skew <= max_skew:
+                    break
+                logger.warning(f"同步拍照時間差 {skew * 1000:.1f}ms 超過上限 {max_skew * 1000:.1f}ms "
+                               f"(第 {attempt + 1} 次)")
+                ref_ts = time.monotonic()
+            else:
+                logger.error(f"同步拍照放棄: 時間差 {skew * 1000:.1f}ms")
+                return None
+
+            results = await asyncio.gather(*(
+                self._finish_capture(name, position_index, frame, info, save_dir=save_dir)
+                for name, (_, frame, info) in zip(camera_names, picks)))
+            if any(result is None for result in results):
+                return None
+            logger.debug(f"同步拍照 {camera_names} 時間差 {skew * 1000:.1f}ms")
+            return {
+                "images": {name: img for name, (_, img, _) in zip(camera_names, results)},
+                "skew": skew,
+                "offsets": {name: info.ts - ref_ts for name, (_, _, info) in zip(camera_names, picks)},
+                "meta": {name: meta for name, (_, _, meta) in zip(camera_names, results)},
+            }
     
     async def set_lamp(self, r: bool, y: bool, g: bool) -> bool:
         """設置三色燈狀態"""
@@ -585,6 +1108,147 @@ class MachineManager:
             "buttons": asdict(self.buttons)
         }
     
+    def keep_warm_cameras(self, camera_names: Optional[List[str]] = None, seconds: float = 30.0):
+        """
+        讓指定攝像頭 (預設全部) 在 seconds 秒內持續擷取，避免掃描時才從閒置喚醒
+        seconds <= 0 代表取消 keep-warm
+        """
+        names = self.get_camera_list() if camera_names is None else camera_names
+        for name in names:
+            cap = self.camera_list.get(name)
+            if cap is None:
+                logger.warning(f"keep-warm 找不到攝像頭: {name}")
+                continue
+            cap.keep_warm(seconds)
+
+    def extend_camera_warm(self, camera_names: List[str], seconds: float) -> Dict[str, Tuple[int, int]]:
+        """
+        暫時延長攝像頭的 keep-warm (掃描期間使用)，不覆蓋使用者設定的較長期限
+        回傳交給 release_camera_warm 的還原資訊
+        """
+        tokens = {}
+        for name in camera_names:
+            cap = self.camera_list.get(name)
+            if cap is None:
+                logger.warning(f"keep-warm 找不到攝像頭: {name}")
+                continue
+            tokens[name] = cap.extend_warm(seconds)
+        return tokens
+
+    def release_camera_warm(self, tokens: Dict[str, Tuple[int, int]]):
+        """還原 extend_camera_warm 之前的 keep-warm 期限"""
+        for name, token in tokens.items():
+            cap = self.camera_list.get(name)
+            if cap is not None:
+                cap.release_warm(token)
+
+    async def lock_camera_exposure(self, camera_names: List[str], timeout: float = 1.0) -> Dict[str, float]:
+        """
+        等待攝像頭自動曝光收斂後鎖定曝光值 (同時進行，最多 timeout 秒)，掃描期間各點位的曝光一致
+        回傳各攝像頭鎖定的曝光值
+        """
+        caps = {name: self.camera_list[name] for name in camera_names if name in self.camera_list}
+        values = await asyncio.gather(*(cap.alock_exposure(timeout) for cap in caps.values()))
+        locked = dict(zip(caps, values))
+        for name, cap in caps.items():
+            status = cap.exposure_status()
+            if status["state"] != "off":
+                logger.info(f"攝像頭 {name} 曝光鎖定於 {locked[name]:.1f} (調整 {status['steps']} 步)")
+        return locked
+
+    def unlock_camera_exposure(self, camera_names: List[str]):
+        """解除曝光鎖定"""
+        for name in camera_names:
+            cap = self.camera_list.get(name)
+            if cap is not None:
+                cap.unlock_exposure()
+
+    async def set_camera_sensor_modes(self, camera_names: List[str], mode: str,
+                                      timeout: float = 2.0) -> Dict[str, Optional[float]]:
+        """
+        將攝像頭切換到指定的感光元件模式 (同時進行)，未設定該模式的攝像頭略過
+        回傳各攝像頭切換到第一幀的耗時 (秒)，失敗或逾時為 None
+        """
+        caps = {name: self.camera_list[name] for name in camera_names
+                if name in self.camera_list and mode in self.camera_list[name].sensor_modes}
+        latencies = await asyncio.gather(*(asyncio.to_thread(cap.set_sensor_mode, mode, timeout)
+                                           for cap in caps.values()))
+        result = dict(zip(caps, latencies))
+        for name, latency in result.items():
+            if latency is None:
+                logger.warning(f"攝像頭 {name} 切換到 {mode} 模式失敗")
+            elif latency > 0:
+                logger.info(f"攝像頭 {name} 切換到 {mode} 模式，第一幀耗時 {latency * 1000:.0f}ms")
+        return result
+
+    def get_camera_status(self) -> dict:
+        """各攝像頭的擷取狀態、喚醒後第一幀耗時、感光元件模式與健康狀態"""
+        return {
+            name: {**cap.warm_status(), **cap.stats(), "exposure": cap.exposure_status(),
+                   "sensor_mode": cap.sensor_mode_status(), "healthy": self.is_camera_healthy(name)}
+            for name, cap in self.camera_list.items()
+        }
+
+    def calibrate_camera_settle(self, camera_name: str, n_frames: int = 30) -> float:
+        """在機構靜止時校正攝像頭的穩定門檻"""
+        cap = self.camera_list[camera_name]
+        threshold = cap.calibrate_settle(n_frames=n_frames)
+        logger.info(f"攝像頭 {camera_name} 穩定門檻: {threshold:.2f}")
+        return threshold
+
+    async def learn_camera_background(self, camera_name: str, n_frames: int = 15) -> bool:
+        """
+        以目前畫面建立攝像頭的空機台背景模型 (機台上不可有工件)，並保存到 roi_dir
+        設定 "roi" 的攝像頭建立 ROI 裁切背景，設定 "presence" 的攝像頭建立工件偵測背景
+        取樣期間持有 scan_lock (會切換感光元件模式)，掃描中回傳 False
+        """
+        detector = self.camera_roi.get(camera_name)
+        presence = self.camera_presence.get(camera_name)
+        if detector is None and presence is None:
+            logger.error(f"{camera_name} 未啟用 ROI 裁切或工件偵測")
+            return False
+        if self.is_scanning():
+            logger.error(f"{camera_name} 掃描中，無法建立背景")
+            return False
+        cap = self.camera_list[camera_name]
+        async with self.scan_lock:
+            # ROI 背景需與掃描影像同解析度，以擷取模式取樣
+            mode = cap.sensor_mode
+            if detector is not None:
+                await self.set_camera_sensor_modes([camera_name], "capture")
+            try:
+                async with self.camera_locks[camera_name]:
+                    frames, _ = await cap.aread_burst(cap.frame_ring.latest_seq(), n_frames,
+                                                      timeout=n_frames * 0.2 + 2.0)
+            finally:
+                await self.set_camera_sensor_modes([camera_name], mode)
+        if len(frames) < 3:
+            logger.error(f"{camera_name} 背景取樣不足: {len(frames)} 幀")
+            return False
+        os.makedirs(self.roi_dir, exist_ok=True)
+        if presence is not None:
+            # 工件偵測使用未校正的預覽縮圖
+            await asyncio.to_thread(presence.learn, [downscale_gray(f) for f in frames])
+            presence.save(os.path.join(self.roi_dir, f"{camera_name}_presence.npz"))
+        if detector is not None:
+            undistorter = self._undistorter_for(camera_name, frames[0])
+            if undistorter is not None:
+                frames = [undistorter.remap(f) for f in frames]
+            await asyncio.to_thread(detector.learn, frames)
+            detector.save(os.path.join(self.roi_dir, f"{camera_name}.npz"))
+        logger.info(f"{camera_name} 空機台背景已更新 ({len(frames)} 幀)")
+        return True
+
+    async def set_camera_exposure(self, camera_name: str, value: Optional[float]) -> bool:
+        """設定攝像頭曝光值，None 改回自動曝光"""
+        cap = self.camera_list[camera_name]
+        return await asyncio.to_thread(cap.set_exposure, value)
+
+    async def set_camera_resolution(self, camera_name: str, width: int, height: int) -> bool:
+        """切換攝像頭擷取解析度 (不能超過啟動時的解析度)"""
+        cap = self.camera_list[camera_name]
+        return await asyncio.to_thread(cap.set_resolution, width, height)
+
     def get_camera_list(self) -> List[str]:
         """獲取所有可用攝像頭名稱"""
         return list(self.camera_list.keys())
@@ -694,21 +1358,25 @@ class MachineManager:
             await asyncio.sleep(0.1)
 
     async def handle_single_motor_sequence(self, motor_id=0, motor_pts=[30, 330], to_shot=False, cam_name='cam0'):
-        """處理單個馬達的運動序列"""
+        """處理單個馬達的運動序列，拍照時每張圖的資訊記錄在 scan_meta[cam_name]"""
         image_list = []
+        meta_list = self.scan_meta.setdefault(cam_name, [])
         for pt in motor_pts:
             ret = await self.motor_move_abs(motor_id, pt)
             if not ret:
                 raise Exception(f"motor {motor_id} moving pt error")
             
             await self.wait_motor_move_to_pos(motor_id, pt)
+            arrive_ts = time.monotonic()
             
             if to_shot:
                 print(f'shot {motor_id}, {pt}, {cam_name}')
-                result = await self.capture_image(cam_name, pt)
+                # 只取抵達後且畫面穩定的幀，不再固定等待
+                result = await self.capture_image(cam_name, pt, after_ts=arrive_ts, motor_id=motor_id)
                 if result is not None:  # 檢查 result 是否為 None
-                    _, img = result
+                    _, img, meta = result
                     image_list.append(img)
+                    meta_list.append(meta)
             else:
                 await asyncio.sleep(0.5)
         ret = await self.motor_move_abs(motor_id, self.motors_home_pos[motor_id])
@@ -724,6 +1392,7 @@ class MachineManager:
         讓馬達移動到指定的點位列表
         """
         # self._state = MachineState.WORKING
+        self.scan_meta = {}
         async with asyncio.TaskGroup() as tg:
             task1 = tg.create_task(self.handle_single_motor_sequence(0, motor0_pts, to_shot, cam_name='cam0'))
             task2 = tg.create_task(self.handle_single_motor_sequence(1, motor1_pts, to_shot, cam_name='cam1'))
@@ -0,0 +1,53 @@
+"""
+掃描後的 360° 合成圖: 將同一攝像頭的各張 (已裁切到工件範圍的) 圖片依拍攝角度排列拼接成一張
+在 MachineManager 的進程池中執行，參數與回傳值都只包含路徑與數值，不傳送影像資料
+"""
+import os
+from typing import List, Optional
+
+import cv2
+import numpy as np
+
+from jpegCodec import JpegEncoder
+
+
+def build_composite(image_paths: List[str], angles: List[float], out_path: str, height: int = 360,
+                    quality: int = 85, label: bool = True, encoder: Optional[JpegEncoder] = None) -> Optional[dict]:
+    """
+    依 angles 由小到大排列 image_paths 的圖片，縮放到相同高度後水平拼接，寫入 out_path
+    label: 在每張圖左上角標示角度
+    回傳 {"file", "width", "height", "angles", "offsets"}，offsets 為每張圖在合成圖中的起始 x，
+    沒有可讀取的圖片時回傳 None
+    """
+    encoder = encoder or JpegEncoder()
+    tiles, used = [], []
+    for angle, path in sorted(zip(angles, image_paths), key=lambda item: item[0]):
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            continue
+        h, w = img.shape[:2]
+        width = max(1, round(w * height / h))
+        tile = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA if h > height else cv2.INTER_LINEAR)
+        if label:
+            text = f"{angle:.1f}"
+            cv2.putText(tile, text, (6, 22), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 3, cv2.LINE_AA)
+            cv2.putText(tile, text, (6, 22), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1, cv2.LINE_AA)
+        tiles.append(tile)
+        used.append(float(angle))
+    if not tiles:
+        return None
+
+    offsets = np.cumsum([0] + [t.shape[1] for t in tiles[:-1]]).tolist()
+    composite = cv2.hconcat(tiles)
+    jpeg = encoder.encode(composite, quality)
+    if jpeg is None:
+        return None
+    with open(out_path, "wb") as f:
+        f.write(jpeg)
+    return {
+        "file": os.path.basename(out_path),
+        "width": int(composite.shape[1]),
+        "height": int(composite.shape[0]),
+        "angles": used,
+        "offsets": [int(x) for x in offsets],
+    }
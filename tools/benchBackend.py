@@ -0,0 +1,118 @@
+"""
+比較擷取後端 (process / thread) 的延遲、CPU 與記憶體 (RSS)
+每個後端在獨立的 python 進程中執行，避免互相影響；RSS 包含擷取子進程 (只支援 Linux /proc)
+
+    python tools/benchBackend.py --cams 2 --src pattern:1280x1024@30 --seconds 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from frameStore import monotonic_ns
+from utils import CAPTURE_BACKENDS
+
+
+def _rss_kb(pid) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def run_backend(backend, cams, src, seconds, level):
+    """在本進程執行單一後端並回傳量測結果"""
+    caps = [CAPTURE_BACKENDS[backend](src) for _ in range(cams)]
+    for cap in caps:
+        cap.start()
+        cap.keep_warm(seconds + 5)
+    for cap in caps:
+        cap.read_after(0, timeout=5.0)
+
+    latency = []
+    rss_samples = []
+    frames = 0
+    last_seq = [-1] * cams
+    t0 = os.times()
+    start = time.monotonic()
+    next_rss = start
+    while time.monotonic() - start < seconds:
+        idle = True
+        for i, cap in enumerate(caps):
+            cap.touch()
+            seq = cap.frame_ring.latest_seq()
+            if seq == last_seq[i]:
+                continue
+            idle = False
+            last_seq[i] = seq
+            info, frame = cap.frame_ring.read(seq, level=level)
+            if info is None:
+                continue
+            latency.append(monotonic_ns() / 1e9 - info.ts)
+            frames += 1
+        if time.monotonic() >= next_rss:
+            pids = [os.getpid()] + [cap.process.pid for cap in caps if backend == "process" and cap.process]
+            rss_samples.append(sum(_rss_kb(pid) for pid in pids))
+            next_rss += 0.5
+        if idle:
+            time.sleep(0.001)
+    elapsed = time.monotonic() - start
+    for cap in caps:
+        cap.stop()
+    # 子進程結束並回收後才會計入 children 的 CPU 時間
+    t1 = os.times()
+    cpu = (t1.user - t0.user) + (t1.system - t0.system)
+    cpu += (t1.children_user - t0.children_user) + (t1.children_system - t0.children_system)
+
+    lat = np.array(latency) * 1000 if latency else np.zeros(1)
+    return {
+        "backend": backend,
+        "fps": frames / elapsed / cams,
+        "latency_p50_ms": float(np.percentile(lat, 50)),
+        "latency_p99_ms": float(np.percentile(lat, 99)),
+        "cpu_percent": cpu / elapsed * 100,
+        "rss_mb": max(rss_samples) / 1024 if rss_samples else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="擷取後端比較")
+    parser.add_argument("--cams", type=int, default=2)
+    parser.add_argument("--src", default="pattern:1280x1024@30", help="來源字串，格式見 frameSources")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--level", type=int, default=0)
+    parser.add_argument("--backends", default=",".join(CAPTURE_BACKENDS))
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        result = run_backend(args.run, args.cams, args.src, args.seconds, args.level)
+        print("RESULT " + json.dumps(result))
+        return
+
+    for backend in args.backends.split(","):
+        cmd = [sys.executable, os.path.abspath(__file__), "--run", backend, "--cams", str(args.cams),
+               "--src", args.src, "--seconds", str(args.seconds), "--level", str(args.level)]
+        out = subprocess.run(cmd, capture_output=True, text=True).stdout
+        lines = [line for line in out.splitlines() if line.startswith("RESULT ")]
+        if not lines:
+            print(f"{backend}: 執行失敗")
+            continue
+        r = json.loads(lines[-1][len("RESULT "):])
+        rss = f"{r['rss_mb']:.0f}MB" if r["rss_mb"] else "N/A"
+        print(f"{backend:8s} {r['fps']:6.1f} fps/cam  延遲 p50 {r['latency_p50_ms']:.2f}ms "
+              f"p99 {r['latency_p99_ms']:.2f}ms  CPU {r['cpu_percent']:.0f}%  RSS {rss}")
+
+
+if __name__ == "__main__":
+    main()
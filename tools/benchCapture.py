@@ -0,0 +1,92 @@
+"""
+不接實體攝影機量測擷取與串流吞吐量
+使用 frameSources 的測試來源，以幀內嵌的計數器統計讀取端丟棄與重複的幀
+
+    python tools/benchCapture.py --cams 2 --src pattern:1280x1024@30 --seconds 10
+    python tools/benchCapture.py --src loop:./testRes/a.mp4@60 --level 2 --jpeg
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from frameStore import monotonic_ns
+from frameSources import read_counter, count_gaps
+from utils import VideoCaptureProcess
+
+
+def main():
+    parser = argparse.ArgumentParser(description="擷取管線基準測試")
+    parser.add_argument("--cams", type=int, default=2, help="攝像頭 (擷取進程) 數量")
+    parser.add_argument("--src", default="pattern:1280x1024@30", help="來源字串，格式見 frameSources")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--level", type=int, default=0, help="讀取的金字塔層級")
+    parser.add_argument("--mode", default="bgr", help="擷取模式 (bgr / mjpg / mjpg+bgr)")
+    parser.add_argument("--jpeg", action="store_true", help="每個新幀都編碼 JPEG，模擬串流")
+    parser.add_argument("--quality", type=int, default=50)
+    parser.add_argument("--demand-fps", type=float, default=0, help="讀取端要求新幀的頻率，0 為每次輪詢都要求")
+    args = parser.parse_args()
+
+    caps = [VideoCaptureProcess(args.src, capture_mode=args.mode) for _ in range(args.cams)]
+    for cap in caps:
+        cap.start()
+        cap.keep_warm(args.seconds + 5)
+    # 等第一幀，排除開啟來源的時間
+    for cap in caps:
+        cap.read_after(0, timeout=5.0)
+
+    counters = [[] for _ in caps]
+    latency = [[] for _ in caps]
+    encode = [[] for _ in caps]
+    last_seq = [-1] * len(caps)
+    next_demand = [0.0] * len(caps)
+    demand_interval = 1.0 / args.demand_fps if args.demand_fps > 0 else 0.0
+    start = time.monotonic()
+    while time.monotonic() - start < args.seconds:
+        idle = True
+        for i, cap in enumerate(caps):
+            now = time.monotonic()
+            if now >= next_demand[i]:
+                cap.touch()
+                next_demand[i] = now + demand_interval
+            seq = cap.frame_ring.latest_seq()
+            if seq == last_seq[i]:
+                continue
+            idle = False
+            last_seq[i] = seq
+            info, frame = cap.frame_ring.read(seq, level=args.level)
+            if info is None or frame is None:
+                continue
+            counters[i].append(read_counter(frame))
+            latency[i].append((monotonic_ns() / 1e9) - info.ts)
+            if args.jpeg:
+                t0 = time.perf_counter()
+                cap.read_jpeg(quality=args.quality, seq=seq, level=args.level)
+                encode[i].append(time.perf_counter() - t0)
+        if idle:
+            time.sleep(0.001)
+    elapsed = time.monotonic() - start
+
+    for i, cap in enumerate(caps):
+        gaps = count_gaps(counters[i])
+        stats = cap.stats()
+        lat = np.array(latency[i]) * 1000 if latency[i] else np.zeros(1)
+        print(f"cam{i}: 讀到 {gaps['frames']} 幀 ({gaps['frames'] / elapsed:.1f} fps)，"
+              f"丟棄 {gaps['dropped']}，重複 {gaps['duplicated']}，"
+              f"擷取端 {stats['fps']:.1f} fps / 丟棄 {stats['dropped_frames']}，"
+              f"grab {stats['grabbed']} / 解碼 {stats['decoded']}")
+        print(f"      延遲 p50 {np.percentile(lat, 50):.2f}ms  p99 {np.percentile(lat, 99):.2f}ms")
+        if encode[i]:
+            enc = np.array(encode[i]) * 1000
+            print(f"      JPEG 編碼 p50 {np.percentile(enc, 50):.2f}ms  p99 {np.percentile(enc, 99):.2f}ms")
+
+    for cap in caps:
+        cap.stop()
+
+
+if __name__ == "__main__":
+    main()
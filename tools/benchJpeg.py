@@ -0,0 +1,81 @@
+"""
+比較 JPEG 編碼器後端 (turbojpeg / opencv) 在掃描與預覽常用解析度、品質下的編碼時間與檔案大小
+未安裝 PyTurboJPEG 時只量測 opencv
+
+    python tools/benchJpeg.py
+    python tools/benchJpeg.py --image ./testRes/1581942.png --sizes 1280x1024,640x512 --qualities 50,95
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from frameSources import test_pattern
+from jpegCodec import JpegEncoder, available_backends
+
+
+def _test_image(path, width, height) -> np.ndarray:
+    """讀取測試圖片，沒有指定時以測試圖樣加上雜訊紋理 (純色塊的壓縮量不具代表性)"""
+    if path:
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            raise SystemExit(f"無法讀取圖片: {path}")
+        return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+    rng = np.random.default_rng(0)
+    noise = cv2.GaussianBlur(rng.integers(0, 255, (height, width, 3), dtype=np.uint8), (0, 0), 2)
+    return cv2.addWeighted(test_pattern(width, height), 0.7, noise, 0.3, 0)
+
+
+def _time_it(fn, repeat):
+    fn()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - t0)
+    return np.array(times) * 1000, out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JPEG 編碼器基準測試")
+    parser.add_argument("--image", help="測試圖片，預設使用合成圖樣")
+    parser.add_argument("--sizes", default="1280x1024,640x512,320x256", help="解析度列表 (掃描原圖、預覽)")
+    parser.add_argument("--qualities", default="50,95")
+    parser.add_argument("--subsampling", default="420,444")
+    parser.add_argument("--repeat", type=int, default=30)
+    args = parser.parse_args()
+
+    backends = available_backends()
+    print(f"可用的編碼器: {', '.join(backends)}")
+    sizes = [tuple(int(v) for v in s.lower().split("x")) for s in args.sizes.split(",")]
+    qualities = [int(q) for q in args.qualities.split(",")]
+    subsamplings = args.subsampling.split(",")
+
+    for width, height in sizes:
+        img = _test_image(args.image, width, height)
+        yuv = cv2.cvtColor(img, cv2.COLOR_BGR2YUV_I420)
+        print(f"\n{width}x{height}")
+        for quality in qualities:
+            for subsampling in subsamplings:
+                for backend in backends:
+                    for fast_dct in ((False, True) if backend == "turbojpeg" else (False,)):
+                        encoder = JpegEncoder(backend, subsampling=subsampling, fast_dct=fast_dct)
+                        ms, jpeg = _time_it(lambda: encoder.encode(img, quality), args.repeat)
+                        name = backend + ("+fastdct" if fast_dct else "")
+                        print(f"  q{quality:<3d} {subsampling}  {name:18s} p50 {np.percentile(ms, 50):6.2f}ms  "
+                              f"p90 {np.percentile(ms, 90):6.2f}ms  {len(jpeg) / 1024:7.1f}KB")
+            # 直接由 YUV 編碼 (輸出固定 4:2:0)
+            for backend in backends:
+                encoder = JpegEncoder(backend)
+                ms, jpeg = _time_it(lambda: encoder.encode_yuv(yuv, width, height, quality), args.repeat)
+                print(f"  q{quality:<3d} yuv  {backend:18s} p50 {np.percentile(ms, 50):6.2f}ms  "
+                      f"p90 {np.percentile(ms, 90):6.2f}ms  {len(jpeg) / 1024:7.1f}KB")
+
+
+if __name__ == "__main__":
+    main()
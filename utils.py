@@ -5,6 +5,19 @@ import multiprocessing as mp
 import numpy as np
 import time
 from collections import deque
+import asyncio
+import threading
+import queue
+import itertools
+
+from frameStore import (SharedFrameRing, monotonic_ns, same_buffer, H_AWAKE, H_WAKE_LAT_NS, H_WAKE_COUNT,
+                        H_WARM_UNTIL_NS, H_IDLE_NS, H_WAKE_NS, H_DROPPED, H_FPS, H_GRABBED, H_DECODED,
+                        H_GRAB_NS, H_POOL_HITS, H_POOL_MISSES, H_AE_STATE, H_AE_LOCK, H_EXPOSURE, H_AE_MEAN,
+                        H_AE_STEPS, H_MODE_LAT_NS, H_MODE_SWITCHES)
+from frameAnalysis import (downscale_gray, motion_energy, calibrate_threshold, build_pyramid, decode_pyramid,
+                           ExposureController)
+from frameSources import open_source, source_size, is_synthetic
+from jpegCodec import JpegEncoder
 
 def get_min_len_path(spList, startPoint):
     def get_pathLen(spList, path):
@@ -291,97 +304,804 @@ def spDict_to_pathList(spDict:dict):
 # ===========================================
 # video multi process
 # ===========================================
-def video_capture_process(src, frame_deque, stop_event, deque_lock, maxlen, block_event, sleep_time):
+# 擷取模式
+# bgr:      解碼為 BGR (原本的行為)
+# mjpg:     只保留攝影機原始 JPEG，需要像素時才在讀取端解碼
+# mjpg+bgr: 同時保留原始 JPEG 與解碼後的 BGR
+CAPTURE_MODES = ("bgr", "mjpg", "mjpg+bgr")
+
+
+def split_mjpg(frame):
+    """
+    CAP_PROP_CONVERT_RGB 關閉時，V4L2 後端回傳 1xN 的原始 MJPG 資料
+    其他後端或來源 (影片檔) 仍回傳解碼後的影像，此時回傳 None
+    """
+    if frame.ndim == 1 or (frame.ndim == 2 and frame.shape[0] == 1):
+        buf = frame.reshape(-1)
+        if buf.size > 2 and buf[0] == 0xFF and buf[1] == 0xD8:
+            return buf
+    return None
+
+
+# 連續讀取失敗超過此次數即結束進程，交由 MachineManager 的監控任務重新啟動
+MAX_READ_FAILURES = 30
+
+
+def apply_capture_control(cap, frame_ring, cmd, args):
+    """
+    在擷取迴圈中執行控制命令，回傳結果 (不支援的命令回傳 None)
+    exposure (value,): value 為 None 時改回自動曝光
+    resolution (width, height): 不能超過 frame_ring 的 slot 大小
+    mode (width, height, fps, issued_ns): 切換感光元件模式 (解析度與幀率)，issued_ns 為呼叫端送出命令的時間
+    get (prop_id,): 讀取 cv2.CAP_PROP_* 屬性
+    """
+    if cmd == "exposure":
+        value, = args
+        if value is None:
+            return bool(cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, 3))
+        cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1)
+        return bool(cap.set(cv2.CAP_PROP_EXPOSURE, value))
+    if cmd == "resolution":
+        width, height = args
+        slot_h, slot_w = frame_ring.slot_shape[:2]
+        if width > slot_w or height > slot_h:
+            print(f"錯誤：解析度 {width}x{height} 超出緩衝大小 {slot_w}x{slot_h}")
+            return False
+        ok_w = cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        ok_h = cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        return bool(ok_w and ok_h)
+    if cmd == "mode":
+        width, height, fps, _ = args
+        if not apply_capture_control(cap, frame_ring, "resolution", (width, height)):
+            return False
+        if fps is not None:
+            cap.set(cv2.CAP_PROP_FPS, fps)
+        return True
+    if cmd == "get":
+        prop, = args
+        return float(cap.get(prop))
+    return None
+
+
+def video_capture_process(src, frame_ring, stop_event, block_event, width=1280, height=1024, capture_mode="bgr",
+                          lazy_decode=True, control=None, control_reply=None, exposure=150, auto_exposure=None,
+                          fps=None):
     """
     在獨立進程中讀取影片幀
     src: 攝影機來源
-    frame_deque: 用於傳遞幀的共享列表
+    frame_ring: 用於傳遞幀的共享記憶體環狀緩衝 (SharedFrameRing)
     stop_event: 用於通知進程停止的事件
-    deque_lock: 用於同步訪問列表的鎖
-    maxlen: 最大幀數
+    block_event: 有讀取需求時才擷取幀的事件，閒置時間與 keep-warm 期限記錄在 frame_ring header
+    capture_mode: 擷取模式，見 CAPTURE_MODES
+    lazy_decode: 只在讀取端要求新幀 (frame_ring.request_frame) 後才解碼，其餘的幀只 grab 不解碼
+    control / control_reply: 控制命令佇列，命令為 (req_id, cmd, args)，結果以 (req_id, result) 回覆，
+    見 apply_capture_control
+    exposure: 初始手動曝光值
+    auto_exposure: 軟體自動曝光參數 (ExposureController 的參數 dict，True 使用預設值)，None 為固定曝光；
+    每次喚醒後以最小層縮圖的亮度直方圖調整曝光，調整期間不受延遲解碼限制，
+    收斂後或讀取端鎖定 (H_AE_LOCK) 後不再調整
+    fps: 幀率，None 時實體攝影機使用 30，測試來源沿用來源字串的幀率
+    mode 命令切換解析度 / 幀率 (fps 為 None 時恢復預設幀率)，從呼叫端送出命令到新模式第一幀寫入的耗時記錄在 H_MODE_LAT_NS
+    金字塔縮圖依 frame_ring.levels 在此產生一次，讀取端直接選用層級
     """
-    cap = cv2.VideoCapture(src)
+    divisors = frame_ring.levels[1:]
+    keep_jpeg = capture_mode in ("mjpg", "mjpg+bgr")
+    decode_bgr = capture_mode != "mjpg"
+    # 實體攝影機交給 cv2.VideoCapture，測試用來源見 frameSources
+    cap = open_source(src, width, height)
     cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-    cap.set(cv2.CAP_PROP_FPS, 30)
+    # 未指定幀率的模式使用的預設幀率: 實體攝影機 30，測試來源沿用來源字串的幀率
+    default_fps = cap.get(cv2.CAP_PROP_FPS) if is_synthetic(src) else 30
+    cap.set(cv2.CAP_PROP_FPS, fps or default_fps)
     # cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
     # cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1024)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
     #cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, 3)
     cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, 1) # manual mode
-    cap.set(cv2.CAP_PROP_EXPOSURE, 150)
+    cap.set(cv2.CAP_PROP_EXPOSURE, exposure)
     cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+    if keep_jpeg and cap.isOpened() and cap.getBackendName() == "V4L2":
+        # 不讓 OpenCV 解碼，直接取得攝影機送出的 JPEG
+        cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    elif keep_jpeg:
+        # 只有 V4L2 後端能直接輸出原始 MJPG (影片檔等來源不支援)
+        print("警告：來源不支援 MJPG 直通，改用 bgr 模式", src)
+        keep_jpeg = False
+        decode_bgr = True
     
-    sleep_time = time.time()
+    # 穩定偵測用的前一幀縮圖
+    prev_small = None
+    prev_ts_ns = 0
+    # 喚醒後第一幀的耗時統計
+    awake = False
+    wake_ns = 0
+    # 健康狀態統計
+    read_failures = 0
+    last_frame_ns = 0
+    # 上次解碼時的需求計數
+    last_demand = -1
+    # 目前輸出的幀尺寸 (解碼緩衝大小) 與尚未出幀的模式切換開始時間
+    frame_shape = (height, width, 3)
+    mode_switch_ns = 0
+    # 軟體自動曝光
+    ae = None
+    if auto_exposure:
+        ae = ExposureController(exposure, **(auto_exposure if isinstance(auto_exposure, dict) else {}))
 
     if not cap.isOpened():
         print("錯誤：無法打開攝影機", src)
         return
         
+    header = frame_ring.header
+    fheader = frame_ring.fheader
+    fheader[H_EXPOSURE] = exposure
+    header[H_AE_STATE] = ae.state if ae is not None else 0
     while not stop_event.is_set():
-        if time.time() - sleep_time > 5:
-            sleep_time = time.time()
+        # 處理曝光、解析度等控制命令，閒置時由 block_event 喚醒處理
+        while control is not None:
+            try:
+                req_id, cmd, args = control.get_nowait()
+            except queue.Empty:
+                break
+            if cmd == "mode" and args[2] is None:
+                args = (args[0], args[1], default_fps, args[3])
+            result = apply_capture_control(cap, frame_ring, cmd, args)
+            control_reply.put((req_id, result))
+            if cmd in ("resolution", "mode"):
+                prev_small = None
+                if result:
+                    frame_shape = (args[1], args[0], 3)
+                    # 切換耗時由呼叫端送出命令時起算，包含佇列傳遞與等待喚醒的時間
+                    if cmd == "mode":
+                        mode_switch_ns = args[3]
+            elif cmd == "exposure" and result:
+                # 手動設定的曝光值保留到下次喚醒，None (攝影機自動曝光) 時停用軟體自動曝光
+                value, = args
+                if value is None:
+                    ae = None
+                    header[H_AE_STATE] = 0
+                else:
+                    fheader[H_EXPOSURE] = value
+                    if ae is not None:
+                        ae.exposure = float(value)
+                        ae.state = ExposureController.CONVERGED
+
+        # 沒有讀取需求且不在 keep-warm 期間時停止擷取，等待喚醒
+        if frame_ring.is_idle():
             block_event.clear()
+            # 清除後再確認一次，避免錯過清除前剛登記的需求
+            if frame_ring.is_idle():
+                awake = False
+                header[H_AWAKE] = 0
+                # 閒置期間不計入模式切換耗時
+                mode_switch_ns = 0
+                block_event.wait()
+                continue
+            block_event.set()
+        if not awake:
+            awake = True
+            wake_ns = monotonic_ns()
+            last_frame_ns = 0
+            header[H_WAKE_NS] = wake_ns
+            header[H_AWAKE] = 1
+            if ae is not None and not header[H_AE_LOCK]:
+                # 閒置期間光線可能改變，喚醒後重新收斂
+                ae.reset()
+                header[H_AE_STATE] = ae.state
+                header[H_AE_STEPS] = 0
         
-        block_event.wait()
-        
-        ret, frame = cap.read()
+        # 每幀都 grab 維持攝影機的節奏，讀取端要求新幀後才 retrieve (解碼)
+        ret = cap.grab()
+        # 以取得幀的時間作為擷取時間戳
+        ts_ns = monotonic_ns()
+        if stop_event.is_set():
+            # 卡在 grab 期間已被要求停止 (可能已有新的擷取執行緒接手)，不再寫入緩衝
+            break
+        if ret:
+            header[H_GRABBED] += 1
+            header[H_GRAB_NS] = ts_ns
+            # 幀率以指數平均平滑，以 grab 計算，反映攝影機實際輸出
+            if last_frame_ns:
+                fps = 1e9 / max(ts_ns - last_frame_ns, 1)
+                prev_fps = frame_ring.fheader[H_FPS]
+                frame_ring.fheader[H_FPS] = fps if prev_fps <= 0 else prev_fps * 0.9 + fps * 0.1
+            last_frame_ns = ts_ns
+            if wake_ns:
+                # 記錄喚醒後第一幀的耗時
+                header[H_WAKE_LAT_NS] = ts_ns - wake_ns
+                header[H_WAKE_COUNT] += 1
+                wake_ns = 0
+            demand = frame_ring.demand_seq()
+            ae_active = ae is not None and not header[H_AE_LOCK]
+            ae_adjusting = ae_active and ae.state == ExposureController.ADJUSTING
+            # 模式切換後的第一幀一律解碼，才能量測切換耗時
+            if lazy_decode and demand == last_demand and not ae_adjusting and not mode_switch_ns:
+                # 上次解碼後沒有新的需求，丟棄此幀
+                read_failures = 0
+                continue
+            last_demand = demand
+            if keep_jpeg:
+                level_bufs = None
+                ret, frame = cap.retrieve()
+            else:
+                # 直接解碼到下一個 slot 的緩衝，尺寸與格式相符時不另外配置記憶體
+                slot_buf, level_bufs = frame_ring.slot_buffers(frame_shape)
+                ret, frame = cap.retrieve(image=slot_buf)
+                if ret:
+                    if same_buffer(slot_buf, frame):
+                        header[H_POOL_HITS] += 1
+                    else:
+                        header[H_POOL_MISSES] += 1
+                        # 攝影機實際輸出的尺寸與設定不同時，下一幀改用實際尺寸的緩衝
+                        if frame.ndim == 3:
+                            frame_shape = frame.shape
             
         if not ret:
-            print("錯誤：無法讀取幀")
-            break
+            header[H_DROPPED] += 1
+            read_failures += 1
+            if read_failures >= MAX_READ_FAILURES:
+                print("錯誤：連續無法讀取幀，結束擷取進程", src)
+                break
+            time.sleep(0.01)
+            continue
+        read_failures = 0
+
+        jpeg = split_mjpg(frame) if keep_jpeg else None
+        if keep_jpeg and jpeg is None:
+            # 攝影機未輸出 MJPG，改回由 OpenCV 解碼
+            print("警告：攝影機未輸出 MJPG，改用 bgr 模式", src)
+            cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+            keep_jpeg = False
+            continue
+        if jpeg is not None and not decode_bgr:
+            # 只保留 JPEG 時，各層縮圖以 DCT 縮放解碼，不做完整解碼
+            frame = None
+            levels = decode_pyramid(jpeg, divisors)
+        else:
+            if jpeg is not None:
+                frame = cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+            levels = build_pyramid(frame, divisors, level_bufs)
+
+        # 運動量以最小的一層計算，沒有金字塔時另外縮小
+        if levels and levels[-1] is not None:
+            small = downscale_gray(levels[-1])
+        elif frame is not None:
+            small = downscale_gray(frame)
+        else:
+            small = downscale_gray(cv2.imdecode(jpeg, cv2.IMREAD_REDUCED_GRAYSCALE_8))
             
-        # 使用鎖來安全地操作共享列表
-        with deque_lock:
-            # 如果列表已滿，移除最舊的幀
-            if len(frame_deque) >= maxlen:
-                frame_deque.pop(0)  # 移除最舊的幀
-            frame_deque.append(frame)
+        # 在縮圖上計算與前一幀的運動量，閒置喚醒後的第一幀不與舊幀比較
+        if ts_ns - prev_ts_ns > 500_000_000:
+            prev_small = None
+        motion = motion_energy(prev_small, small)
+        prev_small, prev_ts_ns = small, ts_ns
+
+        if ae_active:
+            new_exposure = ae.update(small)
+            if new_exposure is not None:
+                cap.set(cv2.CAP_PROP_EXPOSURE, new_exposure)
+                fheader[H_EXPOSURE] = new_exposure
+            fheader[H_AE_MEAN] = ae.mean
+            header[H_AE_STEPS] = ae.steps
+        if ae is not None:
+            header[H_AE_STATE] = ae.state
             
+        # 寫入共享記憶體，讀取端以序號判斷資料是否有效，不需要鎖
+        if frame_ring.write(frame, ts_ns, motion, jpeg=jpeg, levels=levels) < 0:
+            header[H_DROPPED] += 1
+            print("錯誤：幀大小超出緩衝容量")
+            continue
+        header[H_DECODED] += 1
+        if mode_switch_ns:
+            # 記錄模式切換到新模式第一幀可讀取的耗時
+            header[H_MODE_LAT_NS] = monotonic_ns() - mode_switch_ns
+            header[H_MODE_SWITCHES] += 1
+            mode_switch_ns = 0
+
+    # 要求停止時由呼叫端重設狀態，逾時才結束的舊執行緒不覆寫新執行緒的 header
+    if not stop_event.is_set():
+        header[H_AWAKE] = 0
     cap.release()
     print("影片擷取進程已結束")
 
 class VideoCaptureProcess:
-    def __init__(self, src="/dev/video1", maxlen=2):
-        # 創建進程管理器
-        self.manager = mp.Manager()
-        # 用於儲存幀的共享列表
-        self.frame_deque = self.manager.list()
+    # 預設穩定門檻 (縮圖灰階平均絕對差)，可用 calibrate_settle() 依實際環境校正
+    DEFAULT_SETTLE_THRESHOLD = 1.5
+    # 幀緩衝放在共享記憶體，供子進程寫入
+    LOCAL_RING = False
+
+    @staticmethod
+    def _new_event():
+        return mp.Event()
+
+    @staticmethod
+    def _new_queue():
+        return mp.Queue()
+
+    def __init__(self, src="/dev/video1", maxlen=4, width=1280, height=1024, settle_threshold=None,
+                 capture_mode="bgr", pyramid=(1, 2, 4), idle_timeout=5.0, lazy_decode=True, exposure=150,
+                 auto_exposure=None, jpeg_encoder: JpegEncoder = None, sensor_modes: dict = None):
+        if capture_mode not in CAPTURE_MODES:
+            raise ValueError(f"未知的擷取模式: {capture_mode}")
+        # 測試圖樣來源可在來源字串指定解析度
+        width, height = source_size(src, width, height)
+        # 感光元件模式: 名稱 -> (width, height, fps)，fps 為 None 代表預設幀率
+        # "capture" 預設為建立時的解析度；有設定 "preview" 時平時以預覽模式擷取，掃描時再切換
+        self.sensor_modes = {"capture": (width, height, None), **(sensor_modes or {})}
+        # 用於儲存幀的共享記憶體環狀緩衝，maxlen 為 slot 數量
         self.maxlen = maxlen
-        # 用於同步訪問列表的鎖
-        self.deque_lock = mp.Lock()
+        self.sensor_mode = "preview" if "preview" in self.sensor_modes else "capture"
+        self.width, self.height, self.fps = self.sensor_modes[self.sensor_mode]
+        self.capture_mode = capture_mode
+        self.lazy_decode = lazy_decode
+        # 初始曝光值與軟體自動曝光參數，見 video_capture_process
+        self.exposure = exposure
+        self.auto_exposure = auto_exposure
+        # read_jpeg 使用的編碼器 (在讀取端編碼)
+        self.jpeg_encoder = jpeg_encoder or JpegEncoder()
+        # MJPG 壓縮後通常遠小於原始大小，保留一半容量已足夠
+        # slot 大小取各模式中最大的解析度，切換模式不需重新配置共享記憶體
+        width = max(mode[0] for mode in self.sensor_modes.values())
+        height = max(mode[1] for mode in self.sensor_modes.values())
+        jpeg_capacity = width * height // 2 if capture_mode != "bgr" else 0
+        # pyramid: 各層縮小倍率，預覽等只需小圖的讀取端直接選用 level
+        self.frame_ring = SharedFrameRing(nslots=maxlen, slot_shape=(height, width, 3),
+                                          jpeg_capacity=jpeg_capacity, levels=pyramid, local=self.LOCAL_RING)
+        # 沒有讀取需求超過 idle_timeout 秒即停止擷取
+        self.frame_ring.set_idle_timeout(idle_timeout)
         # 用於控制進程停止的事件
-        self.stop_event = mp.Event()
+        self.stop_event = self._new_event()
         # 攝影機來源
         self.src = src
         # 進程物件
         self.process = None
-        self.block_event = mp.Event()
-        self.sleep_time = 0
+        self.block_event = self._new_event()
+        # 控制命令 (曝光、解析度) 與回覆佇列
+        self.control = self._new_queue()
+        self.control_reply = self._new_queue()
+        self._control_lock = threading.Lock()
+        self._control_ids = itertools.count()
+        # 畫面穩定判斷門檻
+        self.settle_threshold = settle_threshold or self.DEFAULT_SETTLE_THRESHOLD
+        # 被監控任務重新啟動的次數
+        self.restart_count = 0
+        self.last_restart = 0.0
         
     def start(self):
         """啟動影片擷取進程"""
         self.stop_event.clear()
         self.process = mp.Process(
             target=video_capture_process,
-            args=(self.src, self.frame_deque, self.stop_event, self.deque_lock, self.maxlen, self.block_event, self.sleep_time)
+            args=(self.src, self.frame_ring, self.stop_event, self.block_event, self.width, self.height,
+                  self.capture_mode, self.lazy_decode, self.control, self.control_reply, self.exposure,
+                  self.auto_exposure, self.fps)
         )
         self.process.daemon = True
         self.process.start()
         
-    def read(self):
-        """從共享列表中獲取最新的幀"""
-        with self.deque_lock:
+    def touch(self):
+        """登記讀取需求 (要求解碼下一幀) 並喚醒擷取進程"""
+        self.frame_ring.request_frame()
+        self.block_event.set()
+
+    def keep_warm(self, seconds: float):
+        """
+        在接下來 seconds 秒內持續擷取，不受閒置時間影響
+        seconds <= 0 代表取消，恢復依讀取需求擷取
+        """
+        until_ns = monotonic_ns() + int(seconds * 1e9) if seconds > 0 else 0
+        self.frame_ring.set_warm_until(until_ns)
+        if seconds > 0:
             self.block_event.set()
-            self.sleep_time = time.time()
-            if len(self.frame_deque) > 0:
-                # 獲取最新的幀（最後一個元素）
-                return True, self.frame_deque[-1]
+
+    def extend_warm(self, seconds: float) -> tuple:
+        """
+        將 keep-warm 延長到至少 seconds 秒後，不縮短既有較長的期限
+        回傳 (原本的期限, 設定後的期限) (monotonic ns)，結束時交給 release_warm 還原
+        """
+        header = self.frame_ring.header
+        prev_ns = int(header[H_WARM_UNTIL_NS])
+        until_ns = max(prev_ns, monotonic_ns() + int(seconds * 1e9))
+        self.frame_ring.set_warm_until(until_ns)
+        self.block_event.set()
+        return prev_ns, until_ns
+
+    def release_warm(self, token: tuple):
+        """撤銷 extend_warm 的延長，期間有其他呼叫端重新設定 keep-warm 時保留對方的設定"""
+        prev_ns, until_ns = token
+        if int(self.frame_ring.header[H_WARM_UNTIL_NS]) == until_ns:
+            self.frame_ring.set_warm_until(prev_ns)
+
+    def set_idle_timeout(self, seconds: float):
+        self.frame_ring.set_idle_timeout(seconds)
+
+    def _control_request(self, cmd: str, *args, timeout: float = 2.0):
+        """送出控制命令並等待擷取迴圈回覆，逾時回傳 None (阻塞，非同步程式請用 asyncio.to_thread)"""
+        with self._control_lock:
+            req_id = next(self._control_ids)
+            self.control.put((req_id, cmd, args))
+            # 閒置中的擷取迴圈需要喚醒才會處理命令
+            self.block_event.set()
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    reply_id, result = self.control_reply.get(timeout=remaining)
+                except queue.Empty:
+                    return None
+                # 丟棄先前逾時的命令遲到的回覆
+                if reply_id == req_id:
+                    return result
+
+    def set_exposure(self, value) -> bool:
+        """設定手動曝光值，None 改回自動曝光"""
+        return bool(self._control_request("exposure", value))
+
+    AE_STATES = {0: "off", 1: "adjusting", 2: "converged", 3: "locked", 4: "gave_up"}
+
+    def exposure_status(self) -> dict:
+        """軟體自動曝光狀態、目前曝光值、最近量測的平均亮度與本次收斂的調整步數"""
+        header, fheader = self.frame_ring.header, self.frame_ring.fheader
+        mean = float(fheader[H_AE_MEAN])
+        state = int(header[H_AE_STATE])
+        if state and header[H_AE_LOCK]:
+            state = 3
+        return {
+            "state": self.AE_STATES.get(state, "off"),
+            "exposure": round(float(fheader[H_EXPOSURE]), 2),
+            "mean": round(mean, 1) if header[H_AE_STATE] else None,
+            "steps": int(header[H_AE_STEPS]),
+        }
+
+    async def alock_exposure(self, timeout: float = 1.0) -> float:
+        """
+        等待自動曝光收斂 (最多 timeout 秒) 後鎖定目前的曝光值，回傳鎖定的曝光值
+        逾時仍會鎖定，掃描期間各張影像的曝光一致
+        """
+        header = self.frame_ring.header
+        self.touch()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if header[H_AWAKE] and header[H_AE_STATE] != 1:
+                break
+            await asyncio.sleep(0.01)
+        header[H_AE_LOCK] = 1
+        return float(self.frame_ring.fheader[H_EXPOSURE])
+
+    def unlock_exposure(self):
+        """解除鎖定，下次喚醒時重新收斂"""
+        self.frame_ring.header[H_AE_LOCK] = 0
+
+    def set_resolution(self, width: int, height: int) -> bool:
+        """切換擷取解析度，不能超過建立時的解析度 (共享記憶體 slot 大小)"""
+        ok = bool(self._control_request("resolution", int(width), int(height)))
+        if ok:
+            self.width, self.height = int(width), int(height)
+        return ok
+
+    def set_sensor_mode(self, name: str, timeout: float = 2.0):
+        """
+        切換到 sensor_modes 中的模式，等待新模式的第一幀 (最多 timeout 秒)
+        回傳切換命令送出到第一幀的耗時 (秒)，已在該模式回傳 0.0，失敗或逾時回傳 None (阻塞)
+        """
+        if name not in self.sensor_modes:
+            raise ValueError(f"未知的感光元件模式: {name}")
+        if name == self.sensor_mode:
+            return 0.0
+        width, height, fps = self.sensor_modes[name]
+        header = self.frame_ring.header
+        switches = int(header[H_MODE_SWITCHES])
+        # 登記讀取需求，閒置中的擷取迴圈切換後才會繼續出幀
+        self.touch()
+        issued_ns = monotonic_ns()
+        if not self._control_request("mode", int(width), int(height), fps, issued_ns, timeout=timeout):
+            return None
+        self.width, self.height, self.fps, self.sensor_mode = int(width), int(height), fps, name
+        deadline = time.monotonic() + timeout
+        while header[H_MODE_SWITCHES] == switches:
+            if time.monotonic() > deadline:
+                return None
+            self.touch()
+            time.sleep(0.002)
+        return int(header[H_MODE_LAT_NS]) / 1e9
+
+    def sensor_mode_status(self) -> dict:
+        """目前的感光元件模式與最近一次切換到第一幀的耗時 (秒)"""
+        header = self.frame_ring.header
+        switches = int(header[H_MODE_SWITCHES])
+        return {
+            "mode": self.sensor_mode,
+            "width": self.width,
+            "height": self.height,
+            "fps": self.fps,
+            "modes": list(self.sensor_modes),
+            "switch_latency": int(header[H_MODE_LAT_NS]) / 1e9 if switches else None,
+            "switch_count": switches,
+        }
+
+    def warm_status(self) -> dict:
+        """擷取狀態與最近一次喚醒到第一幀的耗時 (秒)"""
+        header = self.frame_ring.header
+        lat_ns = int(header[H_WAKE_LAT_NS])
+        warm_left = (int(header[H_WARM_UNTIL_NS]) - monotonic_ns()) / 1e9
+        return {
+            "awake": bool(header[H_AWAKE]),
+            "warm_for": max(0.0, warm_left),
+            "idle_timeout": int(header[H_IDLE_NS]) / 1e9,
+            "first_frame_latency": lat_ns / 1e9 if lat_ns >= 0 else None,
+            "wake_count": int(header[H_WAKE_COUNT]),
+        }
+
+    def read(self, copy=False, level: int = 0):
+        """
+        獲取最新的幀
+        預設回傳指向共享記憶體的唯讀 view，在擷取進程繞回同一個 slot 前有效；
+        需要長時間持有或修改時請使用 copy=True
+        level: 金字塔層級，0 為原始解析度，超出設定的層數時使用最小的一層
+        """
+        self.touch()
+        info, frame = self.frame_ring.read_latest(copy=copy, level=level)
+        frame = self._materialize(info, frame, level)
+        if frame is None:
             return False, None
+        return True, frame
+
+    def _materialize(self, info, frame, level=0):
+        """該層級沒有像素 (只保留 JPEG) 時在此才解碼"""
+        if frame is not None or info is None or info.jpeg_len == 0:
+            return frame
+        jpeg = self.frame_ring.jpeg(info.seq)
+        if jpeg is None:
+            return None
+        jpeg = np.frombuffer(jpeg, np.uint8)
+        level = self.frame_ring.level_index(level)
+        if level == 0:
+            return cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+        return decode_pyramid(jpeg, (self.frame_ring.levels[level],))[0]
+
+    async def _amaterialize(self, info, frame, level=0):
+        """_materialize 的非同步版本，需要解碼時在工作執行緒執行，不阻塞事件迴圈"""
+        if frame is not None or info is None or info.jpeg_len == 0:
+            return frame
+        return await asyncio.to_thread(self._materialize, info, frame, level)
+
+    def read_jpeg(self, quality: int = 90, seq: int = None, level: int = 0):
+        """
+        取得 JPEG 編碼的幀 (預設為最新一幀)
+        原始解析度且有保留攝影機原始 JPEG 時直接回傳，不重新編碼 (quality 不生效)
+        指定 seq 時只讀取緩衝中已有的幀，不要求解碼新幀
+        回傳 (ret, jpeg_bytes, info)
+        """
+        if seq is None:
+            self.touch()
+            seq = self.frame_ring.latest_seq()
+        info = self.frame_ring.info(seq)
+        if info is None:
+            return False, None, None
+        level = self.frame_ring.level_index(level)
+        if info.jpeg_len and level == 0:
+            jpeg = self.frame_ring.jpeg(seq)
+            if jpeg is not None:
+                return True, jpeg, info
+        frame = self._materialize(info, self.frame_ring.view(seq, level), level)
+        if frame is None:
+            return False, None, None
+        jpeg = self.jpeg_encoder.encode(frame, quality)
+        if jpeg is None or not self.frame_ring.is_valid(seq):
+            return False, None, None
+        return True, jpeg, info
+
+    def _peek_after(self, ts, copy):
+        """最新一幀晚於 ts 時回傳 (info, frame)，frame 可能尚未解碼 (None)，否則回傳 (None, None)"""
+        self.touch()
+        info, frame = self.frame_ring.read_latest(copy=copy)
+        if info is None or info.ts <= ts:
+            return None, None
+        return info, frame
+
+    def _try_read_after(self, ts, copy):
+        info, frame = self._peek_after(ts, copy)
+        frame = self._materialize(info, frame)
+        if frame is not None:
+            return True, frame, info
+        return False, None, None
+
+    def read_after(self, ts: float, timeout: float = 1.0, copy=False):
+        """
+        阻塞直到有擷取時間晚於 ts 的幀
+        ts: 與 time.monotonic() 同一時鐘的時間 (秒)
+        回傳 (ret, frame, info)，逾時回傳 (False, None, None)
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            ret, frame, info = self._try_read_after(ts, copy)
+            if ret or time.monotonic() > deadline:
+                return ret, frame, info
+            time.sleep(0.002)
+
+    async def aread_after(self, ts: float, timeout: float = 1.0, copy=False):
+        """read_after 的非同步版本，等待與解碼期間不阻塞事件迴圈"""
+        deadline = time.monotonic() + timeout
+        while True:
+            info, frame = self._peek_after(ts, copy)
+            frame = await self._amaterialize(info, frame)
+            if frame is not None:
+                return True, frame, info
+            if time.monotonic() > deadline:
+                return False, None, None
+            await asyncio.sleep(0.005)
             
-    def stop(self):
-        """停止影片擷取進程"""
+    async def aread_nearest(self, ts: float, timeout: float = 1.0, copy=False):
+        """
+        取得擷取時間最接近 ts 的幀
+        先等到有晚於 ts 的幀，確保 ts 前後兩側的幀都已在緩衝中，再挑時間差最小的一幀
+        回傳 (ret, frame, info)
+        """
+        await self.aread_after(ts, timeout=timeout)
+        for _ in range(self.frame_ring.nslots):
+            seq, _ = self.frame_ring.nearest_seq(ts)
+            if seq < 0:
+                break
+            info, frame = self.frame_ring.read(seq, copy=copy)
+            frame = await self._amaterialize(info, frame)
+            if info is not None and frame is not None:
+                return True, frame, info
+        return False, None, None
+
+    def _try_read_settled(self, ts, threshold, stable_frames, state, copy):
+        """
+        逐一檢查上次檢查之後的新幀，連續 stable_frames 幀運動量低於門檻即視為穩定
+        state: [下一個要檢查的序號, 已連續穩定的幀數]
+        回傳穩定當下的 (ret, frame, info)，frame 可能尚未解碼 (None)，由呼叫端解碼
+        """
+        self.touch()
+        latest = self.frame_ring.latest_seq()
+        # 落後超過緩衝長度的幀已被覆寫，從仍有效的最舊幀開始
+        seq = max(state[0], latest - self.frame_ring.nslots + 1)
+        while seq <= latest:
+            info = self.frame_ring.info(seq)
+            seq += 1
+            if info is None or info.ts <= ts:
+                continue
+            if info.motion < threshold:
+                state[1] += 1
+            else:
+                state[1] = 0
+            if state[1] >= stable_frames:
+                state[0] = seq
+                info, frame = self.frame_ring.read(info.seq, copy=copy)
+                if info is not None:
+                    return True, frame, info
+        state[0] = seq
+        return False, None, None
+
+    async def aread_settled(self, ts: float, timeout: float = 2.0, stable_frames: int = 2,
+                            threshold: float = None, copy=False):
+        """
+        等待 ts 之後畫面穩定 (運動量連續低於門檻)，回傳穩定當下的幀
+        逾時則退回 ts 之後最新的一幀，並在 info.motion 保留實際運動量
+        回傳 (ret, frame, info, settled)
+        """
+        threshold = self.settle_threshold if threshold is None else threshold
+        state = [0, 0]
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            ret, frame, info = self._try_read_settled(ts, threshold, stable_frames, state, copy)
+            if ret:
+                frame = await self._amaterialize(info, frame)
+                if frame is not None:
+                    return True, frame, info, True
+            await asyncio.sleep(0.005)
+        ret, frame, info = await self.aread_after(ts, timeout=0.5, copy=copy)
+        return ret, frame, info, False
+
+    async def aread_burst(self, after_seq: int, count: int, timeout: float = 2.0):
+        """
+        收集序號大於 after_seq 的連續 count 幀 (複本)
+        緩衝繞回而錯過的幀會略過，逾時回傳已收集到的部分
+        回傳 (frames, infos)
+        """
+        frames, infos = [], []
+        seq = after_seq + 1
+        deadline = time.monotonic() + timeout
+        while len(frames) < count and time.monotonic() < deadline:
+            self.touch()
+            latest = self.frame_ring.latest_seq()
+            seq = max(seq, latest - self.frame_ring.nslots + 1)
+            while seq <= latest and len(frames) < count:
+                info, frame = self.frame_ring.read(seq, copy=True)
+                frame = await self._amaterialize(info, frame)
+                seq += 1
+                if frame is not None:
+                    frames.append(frame)
+                    infos.append(info)
+            if len(frames) < count:
+                await asyncio.sleep(0.005)
+        return frames, infos
+
+    def calibrate_settle(self, n_frames: int = 30, k: float = 4.0, timeout: float = 5.0) -> float:
+        """
+        在畫面靜止時收集運動量樣本，校正並更新穩定門檻
+        回傳新的門檻值
+        """
+        energies = []
+        last_seq = self.frame_ring.latest_seq()
+        deadline = time.monotonic() + timeout
+        while len(energies) < n_frames and time.monotonic() < deadline:
+            self.touch()
+            seq = self.frame_ring.latest_seq()
+            if seq != last_seq:
+                info = self.frame_ring.info(seq)
+                # 跳過喚醒後第一幀 (motion 固定為 255)
+                if info is not None and info.motion < 255:
+                    energies.append(info.motion)
+                last_seq = seq
+            time.sleep(0.005)
+        self.settle_threshold = calibrate_threshold(energies, k=k)
+        return self.settle_threshold
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def stalled_for(self) -> float:
+        """
+        擷取中但攝影機沒有送出新幀的時間 (秒)，未在擷取時回傳 0
+        以最近一次 grab 與最近一次喚醒兩者較晚的時間起算，沒有讀取需求而不解碼的幀不算停滯
+        """
+        header = self.frame_ring.header
+        if not header[H_AWAKE]:
+            return 0.0
+        last_ns = max(int(header[H_GRAB_NS]), int(header[H_WAKE_NS]))
+        return max(0.0, (monotonic_ns() - last_ns) / 1e9)
+
+    def restart(self):
+        """重新啟動擷取進程，共享記憶體與序號延續使用"""
+        self._stop_process()
+        self.restart_count += 1
+        self.last_restart = time.monotonic()
+        self.frame_ring.header[H_AWAKE] = 0
+        self.start()
+
+    def stats(self) -> dict:
+        """
+        健康狀態: 幀率、丟棄幀數、重啟次數與最新一幀距今的時間 (秒)
+        grabbed / decoded 為攝影機送出與實際解碼的幀數，差值即延遲解碼省下的解碼次數
+        """
+        header = self.frame_ring.header
+        latest_ts = self.frame_ring.latest_ts()
+        return {
+            "alive": self.is_alive(),
+            "fps": round(float(self.frame_ring.fheader[H_FPS]), 2),
+            "dropped_frames": int(header[H_DROPPED]),
+            "restart_count": self.restart_count,
+            "last_frame_age": time.monotonic() - latest_ts if latest_ts > float('-inf') else None,
+            "frames": self.frame_ring.latest_seq() + 1,
+            "grabbed": int(header[H_GRABBED]),
+            "decoded": int(header[H_DECODED]),
+            "pool": self.pool_stats(),
+        }
+
+    def pool_stats(self) -> dict:
+        """
+        幀緩衝池統計: slot 數量與大小、直接解碼到 slot 的次數 (hits)
+        與因尺寸或格式不符而另外配置的次數 (misses)
+        """
+        header = self.frame_ring.header
+        hits, misses = int(header[H_POOL_HITS]), int(header[H_POOL_MISSES])
+        return {
+            "slots": self.frame_ring.nslots,
+            "slot_bytes": self.frame_ring.slot_bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / (hits + misses) if hits + misses else None,
+        }
+
+    def _stop_process(self):
         self.stop_event.set()
+        self.block_event.set()  # 喚醒等待中的進程以便結束
         if self.process is not None:
             self.process.join(timeout=2)
             if self.process.is_alive():
@@ -389,10 +1109,62 @@ class VideoCaptureProcess:
             self.process.join(timeout=2)
             if self.process.is_alive():
                 self.process.kill()
-        # 清空列表
-        with self.deque_lock:
-            self.frame_deque[:] = []  # 清空共享列表
-        self.manager.shutdown()
+
+    def stop(self):
+        """停止影片擷取進程"""
+        self._stop_process()
+        self.frame_ring.header[H_AWAKE] = 0
+        # 釋放共享記憶體
+        self.frame_ring.close()
+
+
+class VideoCaptureThread(VideoCaptureProcess):
+    """
+    在本進程的執行緒中擷取，介面與 VideoCaptureProcess 相同
+    OpenCV 的 grab / retrieve / resize 等會釋放 GIL；幀緩衝配置在本進程記憶體，
+    不需要額外的進程與共享記憶體，代價是擷取與 API 伺服器共用同一個進程
+    """
+    LOCAL_RING = True
+
+    @staticmethod
+    def _new_event():
+        return threading.Event()
+
+    @staticmethod
+    def _new_queue():
+        return queue.Queue()
+
+    def start(self):
+        """
+        啟動擷取執行緒
+        每次啟動使用新的停止事件: 卡在攝影機讀取而逾時未結束的舊執行緒仍保有已設定的事件，恢復後自行結束
+        """
+        self.stop_event = self._new_event()
+        self.process = threading.Thread(
+            target=video_capture_process,
+            args=(self.src, self.frame_ring, self.stop_event, self.block_event, self.width, self.height,
+                  self.capture_mode, self.lazy_decode, self.control, self.control_reply, self.exposure,
+                  self.auto_exposure, self.fps),
+            name=f"capture-{self.src}",
+            daemon=True,
+        )
+        self.process.start()
+
+    def _stop_process(self):
+        self.stop_event.set()
+        self.block_event.set()  # 喚醒等待中的執行緒以便結束
+        if self.process is not None:
+            # 執行緒無法強制結束，卡在攝影機讀取時只能等待逾時後放棄
+            self.process.join(timeout=2)
+            if self.process.is_alive():
+                print("警告：擷取執行緒未在時限內結束", self.src)
+
+
+# 擷取後端，camera config 的 "backend" 欄位
+CAPTURE_BACKENDS = {
+    "process": VideoCaptureProcess,
+    "thread": VideoCaptureThread,
+}
 
 
 